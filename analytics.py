@@ -0,0 +1,121 @@
+"""
+Occupancy Analytics
+*******************
+
+Vectorized occupancy, vacancy and lost-rent figures per property and month.
+Requires NumPy.
+
+"""
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+import numpy as np
+
+from contracts.models import LeaseContract
+
+from .models import Property, PropertyListing
+
+
+def month_starts(start, end):
+    """ Get the first day of each month in a date range
+
+    The first entry is ``start`` itself, which may fall mid-month.
+
+    :param start:   First day of the range
+    :type start:    datetime.date
+    :param end:     Last day of the range
+    :type end:      datetime.date
+    :return:        Start of every month segment of the range
+    :rtype:         list of datetime.date
+    """
+    starts = [start]
+    month = date(start.year, start.month, 1) + relativedelta(months=1)
+    while month <= end:
+        starts.append(month)
+        month += relativedelta(months=1)
+    return starts
+
+
+def occupancy_matrix(property_ids, leases, start, end):
+    """ Build the daily occupancy matrix of a set of properties
+
+    :param property_ids:    Properties, in row order
+    :type property_ids:     numpy.ndarray of int, sorted
+    :param leases:          (property id, start date, end date) rows
+    :type leases:           iterable of tuple
+    :param start:           First day of the range
+    :type start:            datetime.date
+    :param end:             Last day of the range
+    :type end:              datetime.date
+    :return:                Matrix of shape (properties, days), True where a
+                            lease is in effect
+    :rtype:                 numpy.ndarray of bool
+    """
+    days = end.toordinal() - start.toordinal() + 1
+    if not len(property_ids):
+        return np.zeros((0, days), dtype=bool)
+    leases = np.array([(property_id, lease_start.toordinal(), lease_end.toordinal())
+                       for property_id, lease_start, lease_end in leases],
+                      dtype=np.int64).reshape(-1, 3)
+
+    rows = np.searchsorted(property_ids, leases[:, 0])
+    known = (rows < len(property_ids)) & \
+        (property_ids[np.minimum(rows, len(property_ids) - 1)] == leases[:, 0])
+    rows = rows[known]
+    first = np.clip(leases[known, 1] - start.toordinal(), 0, days)
+    last = np.clip(leases[known, 2] - start.toordinal() + 1, 0, days)
+
+    # Mark lease starts and ends, then integrate along the days
+    changes = np.zeros((len(property_ids), days + 1), dtype=np.int16)
+    np.add.at(changes, (rows, first), 1)
+    np.add.at(changes, (rows, last), -1)
+    return np.cumsum(changes, axis=1, dtype=np.int16)[:, :days] > 0
+
+
+def monthly_occupancy(start, end, properties=None):
+    """ Compute occupancy, vacancy and lost rent per property and month
+
+    Lost rent prices each vacant day at the listing's monthly rent spread
+    over the year.  Properties without a listing count no lost rent.
+
+    :param start:       First day of the range
+    :type start:        datetime.date
+    :param end:         Last day of the range
+    :type end:          datetime.date
+    :param properties:  Properties to include, all of them by default
+    :type properties:   django.models.QuerySet
+    :return:            Dict of ``properties`` (ids, one per row), ``months``
+                        (segment start dates, one per column) and the
+                        ``occupancy_rate``, ``vacancy_days`` and
+                        ``lost_rent`` matrices
+    :rtype:             dict
+    """
+    if properties is None:
+        properties = Property.objects.all()
+    property_ids = np.array(sorted(properties.values_list('pk', flat=True)),
+                            dtype=np.int64)
+    leases = LeaseContract.objects.filter(property__in=properties.values('pk'),
+                                          start_date__lte=end,
+                                          end_date__gte=start) \
+        .values_list('property', 'start_date', 'end_date')
+    occupied = occupancy_matrix(property_ids, leases.iterator(), start, end)
+
+    months = month_starts(start, end)
+    offsets = np.array([month.toordinal() - start.toordinal() for month in months])
+    days = np.diff(np.append(offsets, end.toordinal() - start.toordinal() + 1))
+    occupied_days = np.add.reduceat(occupied, offsets, axis=1, dtype=np.int32)
+    vacancy_days = days - occupied_days
+
+    rent = np.zeros(len(property_ids))
+    listings = PropertyListing.objects.filter(property__in=properties.values('pk')) \
+        .values_list('property', 'rent')
+    for property_id, monthly_rent in listings:
+        rent[np.searchsorted(property_ids, property_id)] = float(monthly_rent)
+
+    return {
+        'properties': property_ids,
+        'months': months,
+        'occupancy_rate': occupied_days / days.astype(float),
+        'vacancy_days': vacancy_days,
+        'lost_rent': vacancy_days * (rent * 12 / 365.)[:, np.newaxis],
+    }
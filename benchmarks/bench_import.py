@@ -0,0 +1,63 @@
+"""
+Import-time benchmark
+*********************
+
+Measures the cold-start cost of importing modules in a fresh interpreter,
+after Django itself is set up, to track web worker and management command
+startup time.
+
+Usage::
+
+    DJANGO_SETTINGS_MODULE=neighborhood_space.settings \\
+        python benchmarks/bench_import.py unified_messages.views [more.modules]
+
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+SNIPPET = """
+import time
+import django
+django.setup()
+start = time.time()
+import %s
+print(time.time() - start)
+"""
+
+
+def measure(module, runs):
+    """ Import a module in ``runs`` fresh interpreters
+
+    :param module:  Dotted module path
+    :type module:   str
+    :param runs:    Number of interpreters to start
+    :type runs:     int
+    :return:        Import times in seconds, sorted
+    :rtype:         list of float
+    """
+    times = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', SNIPPET % module],
+                                         env=os.environ.copy())
+        times.append(float(output.strip().splitlines()[-1]))
+    return sorted(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('modules', nargs='+', help="Modules to import")
+    parser.add_argument('--runs', type=int, default=10,
+                        help="Fresh interpreters per module")
+    args = parser.parse_args()
+
+    for module in args.modules:
+        times = measure(module, args.runs)
+        print("%-40s min %7.1f ms  median %7.1f ms  max %7.1f ms" %
+              (module, times[0] * 1000, times[len(times) // 2] * 1000,
+               times[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
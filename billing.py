@@ -0,0 +1,98 @@
+"""
+Rent Billing
+************
+
+Batch creation of the monthly rent invoices that Property.get_rent_status
+expects to find for every active lease.
+
+"""
+import logging
+
+from django.db import transaction
+from contracts.models import LeaseContract, ManagementContract
+from finances.models import Invoice, InvoiceType
+
+from .models import (PropertyActivity, RentSchedule, activity_cache,
+                     activity_entries, next_rent_due_date)
+
+
+def _store_invoice_activity(rent_type, today, due):
+    """ Store the activity events of freshly inserted rent invoices
+
+    bulk_create sends no post_save, so the events and cached feeds that
+    refresh_activity would maintain are handled here.
+
+    :param rent_type:   The Rent invoice type
+    :type rent_type:    InvoiceType
+    :param today:       Issue date of the new invoices
+    :type today:        datetime.date
+    :param due:         Property of each new invoice by (payer, due date)
+    :type due:          dict
+    """
+    invoices = Invoice.objects.filter(type=rent_type, issued_date=today,
+                                      payer__in=set(tenant_id for tenant_id, _ in due),
+                                      due_date__in=set(due_date for _, due_date in due)) \
+        .select_related('type', 'payer', 'payee')
+    entries = []
+    for invoice in invoices.iterator():
+        if (invoice.payer_id, invoice.due_date) in due:
+            entries.extend(activity_entries(invoice))
+    PropertyActivity.objects.bulk_create(entries, batch_size=1000)
+    for property_id in set(due.values()):
+        activity_cache.invalidate(property_id)
+
+
+def generate_rent_invoices(today, batch_size=1000):
+    """ Create the missing rent invoices for the upcoming due dates
+
+    Computes the next due date of every lease running on ``today`` in one
+    pass, diffs that against the rent invoices that already exist and inserts
+    the rest in chunks.  Running it again creates nothing, so it can be
+    scheduled as often as needed.
+
+    Invoices are payable to the manager of the property's active management
+    contract, when there is one.
+
+    :param today:       The date to bill from
+    :type today:        datetime.date
+    :param batch_size:  Invoices per insert
+    :type batch_size:   int
+    :return:            Number of invoices created
+    :rtype:             int
+    """
+    leases = LeaseContract.objects.filter(start_date__lte=today,
+                                          end_date__gte=today)
+    due = {}
+    for property_id, tenant_id, rent_due_day, end_date in \
+            leases.values_list('property', 'tenant', 'rent_due_day',
+                               'end_date').iterator():
+        due_date = next_rent_due_date(today, rent_due_day)
+        if due_date <= end_date:
+            due[(tenant_id, due_date)] = property_id
+    if not due:
+        return 0
+
+    rent_type = InvoiceType.objects.get(name="Rent")
+    existing = Invoice.objects.filter(type=rent_type,
+                                      due_date__in=set(due_date for _, due_date in due))
+    for key in existing.values_list('payer', 'due_date').iterator():
+        due.pop(key, None)
+
+    managers = dict(ManagementContract.objects.filter(start_date__lte=today,
+                                                      end_date__gte=today)
+                    .values_list('property', 'manager'))
+
+    invoices = [Invoice(type=rent_type, property_id=property_id,
+                        payer_id=tenant_id, payee_id=managers.get(property_id),
+                        issued_date=today, due_date=due_date)
+                for (tenant_id, due_date), property_id in sorted(due.items())]
+    with transaction.atomic():
+        for start in range(0, len(invoices), batch_size):
+            Invoice.objects.bulk_create(invoices[start:start+batch_size])
+        # bulk_create sends no post_save, so link the schedule here
+        RentSchedule.objects.filter(due_date__in=set(invoice.due_date for invoice in invoices)) \
+            .link_invoices()
+        _store_invoice_activity(rent_type, today, due)
+
+    logging.debug("Created %d rent invoices" % len(invoices))
+    return len(invoices)
@@ -0,0 +1,228 @@
+"""
+Message Body Storage
+********************
+
+Compressed storage of large message bodies.  Bodies under the threshold stay
+in Message.body untouched.  Larger ones are zlib-compressed and either kept
+in the row as base64, or offloaded to the content-addressed MessageBodyBlob
+table, where identical bodies are stored once.  Either way the column then
+holds a short printable reference such as ``[message body sha1:...]``.
+Bodies that start like a reference are compressed whatever their length, so
+a body received from outside is never taken for a reference.
+
+install() makes this transparent to code using the model: bodies are
+encoded when a message is saved, and ``message.body`` resolves a reference
+the first time it is read.  Only reads that bypass model instances, such as
+values() or raw SQL, see the reference itself.
+
+Settings:
+
+* MESSAGE_BODY_COMPRESS_THRESHOLD - bodies longer than this many characters
+  are compressed, 16 KB by default
+* MESSAGE_BODY_BACKEND - 'blob' to offload compressed bodies (the default) or
+  'inline' to keep them in the message row
+* MESSAGE_BODY_MAX_SIZE - most bytes a reference is decompressed to, 16 MB by
+  default.  It must exceed the largest body ever stored.
+
+"""
+import base64
+import hashlib
+import logging
+import re
+import zlib
+
+from django.conf import settings
+from django.db.models.query_utils import DeferredAttribute
+from django.db.models.signals import class_prepared
+
+PREFIX = u"[message body "
+REFERENCE = re.compile(r'^\[message body (zlib|sha1):([A-Za-z0-9_=-]+)\]$')
+
+
+def _threshold():
+    return getattr(settings, 'MESSAGE_BODY_COMPRESS_THRESHOLD', 16 * 1024)
+
+
+def _max_size():
+    return getattr(settings, 'MESSAGE_BODY_MAX_SIZE', 16 * 1024 * 1024)
+
+
+def is_encoded(stored):
+    """ Tell whether a stored body is a reference to a compressed body
+
+    :rtype:     bool
+    """
+    return bool(stored) and stored.startswith(PREFIX) and \
+        REFERENCE.match(stored) is not None
+
+
+def encode_body(body, backend=None):
+    """ Get the value to store in Message.body for a body
+
+    :param body:        The message body
+    :type body:         unicode
+    :param backend:     'blob' or 'inline', MESSAGE_BODY_BACKEND by default
+    :type backend:      str
+    :return:            The body itself, or a reference to its compressed form
+    :rtype:             unicode
+    """
+    if not body:
+        return body
+    raw = body.encode('utf-8') if not isinstance(body, bytes) else body
+    if len(body) <= _threshold() and not raw.startswith(PREFIX.encode('ascii')):
+        return body
+    if backend is None:
+        backend = getattr(settings, 'MESSAGE_BODY_BACKEND', 'blob')
+
+    compressed = zlib.compress(raw, 6)
+    if backend == 'inline':
+        return u"[message body zlib:%s]" % base64.urlsafe_b64encode(compressed).decode('ascii')
+
+    from .models import MessageBodyBlob
+
+    digest = hashlib.sha1(raw).hexdigest()
+    MessageBodyBlob.objects.get_or_create(digest=digest,
+                                          defaults={'data': compressed,
+                                                    'size': len(raw)})
+    return u"[message body sha1:%s]" % digest
+
+
+def decode_body(stored):
+    """ Get the body a value of Message.body stands for
+
+    A reference that cannot be resolved, such as a body stored before
+    references existed that happens to look like one, is logged and returned
+    as it is.
+
+    :param stored:  The value of Message.body
+    :type stored:   unicode
+    :return:        The message body
+    :rtype:         unicode
+    """
+    if not is_encoded(stored):
+        return stored
+    kind, value = REFERENCE.match(stored).groups()
+    try:
+        if kind == 'zlib':
+            compressed = base64.urlsafe_b64decode(value.encode('ascii'))
+        else:
+            from .models import MessageBodyBlob
+
+            compressed = bytes(MessageBodyBlob.objects.get(digest=value).data)
+        limit = _max_size()
+        raw = zlib.decompressobj().decompress(compressed, limit + 1)
+        if len(raw) > limit:
+            raise ValueError("Decompresses to more than %d bytes" % limit)
+        return raw.decode('utf-8')
+    except Exception:
+        logging.warning("Unresolvable message body reference %s" % stored[:80],
+                        exc_info=True)
+        return stored
+
+
+class StoredBody(object):
+    """ Descriptor of a body field resolving stored references on first read
+
+    The instance keeps the stored value, and the decoded body is cached next
+    to it, so a blob is read at most once per loaded message and not at all
+    unless the body is used.  Assigned values are flagged as plain text, so
+    they are encoded on save and never decoded.
+    """
+    def __init__(self, attname):
+        self.attname = attname
+        self.cache = '_%s_decoded' % attname
+        self.plain = '_%s_plain' % attname
+
+    def decoded(self, instance, stored):
+        if instance.__dict__.get(self.plain):
+            return stored
+        cached = instance.__dict__.get(self.cache)
+        if cached is None or cached[0] is not stored:
+            cached = (stored, decode_body(stored))
+            instance.__dict__[self.cache] = cached
+        return cached[1]
+
+    def assign(self, instance, value):
+        instance.__dict__[self.attname] = value
+        instance.__dict__[self.plain] = True
+        instance.__dict__.pop(self.cache, None)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            stored = instance.__dict__[self.attname]
+        except KeyError:
+            raise AttributeError(self.attname)
+        return self.decoded(instance, stored)
+
+    def __set__(self, instance, value):
+        self.assign(instance, value)
+
+
+class DeferredStoredBody(DeferredAttribute):
+    """ StoredBody for deferred loading of the body field
+
+    A deferred body is loaded through refresh_from_db(), which assigns the
+    decoded body.
+    """
+    def __init__(self, field_name, model):
+        super(DeferredStoredBody, self).__init__(field_name, model)
+        self.stored_body = StoredBody(field_name)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        stored = super(DeferredStoredBody, self).__get__(instance, owner)
+        return self.stored_body.decoded(instance, stored)
+
+    def __set__(self, instance, value):
+        self.stored_body.assign(instance, value)
+
+
+def install(model, field_name='body'):
+    """ Store a text field of a model through this module
+
+    Values are encoded when saved and resolved when read, including on
+    instances with the field deferred.
+
+    :param model:       The model class
+    :type model:        django.db.models.Model
+    :param field_name:  Name of the text field
+    :type field_name:   str
+    """
+    field = model._meta.get_field(field_name)
+    descriptor = StoredBody(field.attname)
+    setattr(model, field.attname, descriptor)
+
+    from_db = model.from_db.__func__
+
+    def stored_from_db(cls, db, field_names, values):
+        instance = from_db(cls, db, field_names, values)
+        # Loaded values are stored forms, whatever they look like
+        instance.__dict__.pop(descriptor.plain, None)
+        return instance
+    model.from_db = classmethod(stored_from_db)
+
+    pre_save = field.pre_save
+
+    def encoding_pre_save(instance, add):
+        if field.attname not in instance.__dict__:
+            return pre_save(instance, add)
+        value = instance.__dict__[field.attname]
+        if not instance.__dict__.get(descriptor.plain):
+            return value
+        stored = encode_body(value)
+        instance.__dict__[field.attname] = stored
+        instance.__dict__[descriptor.cache] = (stored, value)
+        del instance.__dict__[descriptor.plain]
+        return stored
+    field.pre_save = encoding_pre_save
+
+    def install_deferred(sender, **kwargs):
+        if getattr(sender, '_deferred', False) and issubclass(sender, model) and \
+                isinstance(sender.__dict__.get(field.attname), DeferredAttribute):
+            setattr(sender, field.attname, DeferredStoredBody(field.attname, sender))
+    class_prepared.connect(install_deferred, weak=False,
+                           dispatch_uid="body-store-%s.%s" % (model._meta.app_label,
+                                                              model._meta.model_name))
@@ -0,0 +1,216 @@
+"""
+Caching
+*******
+
+A bounded in-process LRU tier in front of Django's cache framework.
+
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from django.core.cache import caches
+
+
+def bump_version(cache, key):
+    """ Increment a version counter in a shared cache
+
+    :param cache:   The Django cache holding the counter
+    :param key:     Cache key of the counter
+    :type key:      str
+    """
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add and incr
+        cache.set(key, 1, None)
+
+
+class LRUCache(object):
+    """ A thread-safe, size-bounded least-recently-used mapping
+
+    Keeps hit, miss and eviction counters for sizing.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """ Get a value and mark it most recently used """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """ Store a value, evicting the least recently used ones if full """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, predicate):
+        """ Drop every entry whose key matches a predicate
+
+        :param predicate:   Called with each key
+        :type predicate:    callable
+        """
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def stats(self):
+        """ Get the cache counters
+
+        :return:    Hits, misses, evictions and current size
+        :rtype:     dict
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._data)}
+
+
+class ActivityCache(object):
+    """ Two-tier cache of activity feeds per (user, property, day)
+
+    Entries are versioned per property in the shared cache, so invalidating a
+    property in one process is seen by all of them.
+    """
+    def __init__(self, compute, maxsize=1024, timeout=24 * 60 * 60,
+                 alias='default'):
+        """
+        :param compute:     Builds a feed, called with (property, user, today)
+        :type compute:      callable
+        :param maxsize:     Entries kept in the in-process tier
+        :type maxsize:      int
+        :param timeout:     Seconds entries live in the shared cache
+        :type timeout:      int
+        :param alias:       Name of the Django cache to use
+        :type alias:        str
+        """
+        self.compute = compute
+        self.timeout = timeout
+        self.alias = alias
+        self.local = LRUCache(maxsize)
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def _version_key(property_id):
+        return "property-activity-version:%d" % property_id
+
+    def get_activity(self, property, user, today):
+        """ Get a property's activity feed for a user, computing it if needed
+
+        :param property:    The property
+        :type property:     Property
+        :param user:        The user to generate events for
+        :type user:         UserProfile
+        :param today:       The date the activities are being viewed
+        :type today:        datetime.date
+        :return:            List of event dicts
+        :rtype:             list of dict
+        """
+        version = self.shared.get(self._version_key(property.pk), 0)
+        key = (property.pk, user.pk, today.isoformat(), version)
+        activity = self.local.get(key)
+        if activity is None:
+            shared_key = "property-activity:%d:%d:%s:%d" % key
+            activity = self.shared.get(shared_key)
+            if activity is None:
+                self.shared_misses += 1
+                activity = self.compute(property, user, today)
+                self.shared.set(shared_key, activity, self.timeout)
+            else:
+                self.shared_hits += 1
+            self.local.set(key, activity)
+        return [dict(event) for event in activity]
+
+    def invalidate(self, property_id):
+        """ Drop every cached feed of a property
+
+        :param property_id: The property whose feeds changed
+        :type property_id:  int
+        """
+        bump_version(self.shared, self._version_key(property_id))
+        self.local.discard(lambda key: key[0] == property_id)
+
+    def stats(self):
+        """ Get the hit, miss and eviction counters of both tiers
+
+        :return:    Counters of the local tier, plus shared hits and misses
+        :rtype:     dict
+        """
+        stats = self.local.stats()
+        stats.update(shared_hits=self.shared_hits,
+                     shared_misses=self.shared_misses)
+        return stats
+
+
+class SharedIndex(object):
+    """ Base of in-process indexes that every process reloads on invalidation
+
+    invalidate() bumps a version counter in the shared cache, which each
+    process compares with the version it loaded.  Copies older than
+    ``max_age`` seconds are reloaded regardless, in case the cache is not
+    shared between processes.  Subclasses implement load().
+    """
+    #: Shared cache key of the index version
+    version_key = None
+
+    def __init__(self, max_age=300, alias='default'):
+        """
+        :param max_age:     Most seconds a loaded copy is used
+        :type max_age:      int
+        :param alias:       Name of the Django cache holding the version
+        :type alias:        str
+        """
+        self.max_age = max_age
+        self.alias = alias
+        self._lock = threading.Lock()
+        self._stale = True
+        self._version = None
+        self._loaded_at = 0
+
+    def invalidate(self, **kwargs):
+        """ Reload the index on next use, in every process """
+        self._stale = True
+        bump_version(caches[self.alias], self.version_key)
+
+    def refresh(self):
+        """ Reload the index if it is out of date """
+        version = caches[self.alias].get(self.version_key, 0)
+        with self._lock:
+            if not self._stale and version == self._version and \
+                    time.time() - self._loaded_at < self.max_age:
+                return
+            self._stale = False
+            self._version = version
+            self._loaded_at = time.time()
+            try:
+                self.load()
+            except Exception:
+                self._stale = True
+                raise
+
+    def load(self):
+        """ Rebuild the index from the database """
+        raise NotImplementedError
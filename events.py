@@ -0,0 +1,91 @@
+"""
+Activity Events
+***************
+
+Compact event records for the property activity feed.
+
+"""
+from datetime import datetime
+import json
+
+
+class ActivityEvent(object):
+    """ One event of an activity feed
+
+    Hashable, so duplicate events collapse in a set, and carries its sort key
+    so feeds sort without touching the dates again.  Iterating an event yields
+    its (field, value) pairs, so ``dict(event)`` gives the feed's dict shape.
+    """
+    __slots__ = ('headline', 'date', 'person', 'actionText', 'action', 'type',
+                 'sort_key', '_hash')
+
+    FIELDS = ('headline', 'date', 'person', 'actionText', 'action', 'type')
+
+    def __init__(self, headline, date, person, actionText, action, type):
+        self.headline = headline
+        self.date = date
+        self.person = person
+        self.actionText = actionText
+        self.action = action
+        self.type = type
+        day = date.date() if isinstance(date, datetime) else date
+        self.sort_key = day.toordinal()
+        self._hash = hash(self._values())
+
+    def _values(self):
+        return (self.headline, self.date, self.person, self.actionText,
+                self.action, self.type)
+
+    def __eq__(self, other):
+        if not isinstance(other, ActivityEvent):
+            return NotImplemented
+        return self._hash == other._hash and self._values() == other._values()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return self._hash
+
+    def __iter__(self):
+        return iter(zip(self.FIELDS, self._values()))
+
+    def __repr__(self):
+        return "<ActivityEvent %s: %s>" % (self.date, self.headline)
+
+    def as_dict(self):
+        """ Get the event in the dict format returned by get_activity
+
+        :return:    The event dict
+        :rtype:     dict
+        """
+        return {'headline': self.headline, 'date': self.date,
+                'person': self.person, 'actionText': self.actionText,
+                'action': self.action, 'type': self.type}
+
+    def as_json(self):
+        """ Get the event as JSON-ready primitives
+
+        Dates are ISO 8601 strings and the person is its primary key.
+
+        :return:    The event dict
+        :rtype:     dict
+        """
+        return {'headline': self.headline, 'date': self.date.isoformat(),
+                'person': self.person.pk if self.person is not None else None,
+                'actionText': self.actionText, 'action': self.action,
+                'type': self.type}
+
+
+def serialize_events(events):
+    """ Serialize activity events or event dicts to a JSON array
+
+    :param events:  Events as returned by get_activity or build_event
+    :type events:   iterable of ActivityEvent or dict
+    :return:        JSON document
+    :rtype:         str
+    """
+    return json.dumps([(event if isinstance(event, ActivityEvent)
+                        else ActivityEvent(**event)).as_json()
+                       for event in events])
@@ -0,0 +1,207 @@
+"""
+Geospatial Search
+*****************
+
+Geohash-indexed "near me" and bounding-box searches over active listings,
+and pluggable geocoding of property addresses.
+
+"""
+import csv
+import math
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+EARTH_RADIUS_KM = 6371.0088
+
+#: Precision of the geohashes stored on properties
+GEOHASH_PRECISION = 9
+
+
+def geohash_encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """ Encode a point as a geohash
+
+    :param latitude:    Degrees north
+    :type latitude:     float
+    :param longitude:   Degrees east
+    :type longitude:    float
+    :param precision:   Characters in the hash
+    :type precision:    int
+    :return:            The geohash
+    :rtype:             str
+    """
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        span, point = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (span[0] + span[1]) / 2
+        value <<= 1
+        if point >= middle:
+            value |= 1
+            span[0] = middle
+        else:
+            span[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = 0
+            value = 0
+    return "".join(chars)
+
+
+def cell_size(precision):
+    """ Get the height and width in degrees of a geohash cell
+
+    :rtype:     tuple of float
+    """
+    lat_bits = precision * 5 // 2
+    lon_bits = precision * 5 - lat_bits
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def covering_cells(south, west, north, east, max_cells=16):
+    """ Get the geohash prefixes whose cells cover a bounding box
+
+    Picks the finest precision that needs at most ``max_cells`` cells.
+
+    :return:    Geohash prefixes
+    :rtype:     set of str
+    """
+    south, north = max(south, -90.0), min(north, 90.0)
+    west, east = max(west, -180.0), min(east, 180.0)
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        rows = int(math.ceil((north - south) / height)) + 1
+        columns = int(math.ceil((east - west) / width)) + 1
+        if rows * columns <= max_cells or precision == 1:
+            break
+    cells = set()
+    for row in range(rows + 1):
+        latitude = min(south + row * height, north)
+        for column in range(columns + 1):
+            longitude = min(west + column * width, east)
+            cells.add(geohash_encode(latitude, longitude, precision))
+    return cells
+
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    """ Get the great-circle distance between two points
+
+    :return:    Distance in kilometers
+    :rtype:     float
+    """
+    lat1, lat2 = math.radians(latitude1), math.radians(latitude2)
+    dlat = lat2 - lat1
+    dlon = math.radians(longitude2 - longitude1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _in_cells(queryset, cells):
+    match = Q()
+    for cell in cells:
+        match |= Q(property__geohash__startswith=cell)
+    return queryset.filter(match)
+
+
+def listings_in_bbox(queryset, south, west, north, east):
+    """ Get the listings inside a bounding box
+
+    :param queryset:    Listings to search, e.g. active ones
+    :type queryset:     django.models.QuerySet
+    :return:            Matching listings
+    :rtype:             list of PropertyListing
+    """
+    candidates = _in_cells(queryset, covering_cells(south, west, north, east)) \
+        .select_related('property')
+    return [listing for listing in candidates
+            if south <= listing.property.latitude <= north and
+            west <= listing.property.longitude <= east]
+
+
+def listings_near(queryset, latitude, longitude, radius_km, limit=None):
+    """ Get the listings within a distance of a point, nearest first
+
+    :param queryset:    Listings to search, e.g. active ones
+    :type queryset:     django.models.QuerySet
+    :param latitude:    Degrees north
+    :type latitude:     float
+    :param longitude:   Degrees east
+    :type longitude:    float
+    :param radius_km:   Search radius in kilometers
+    :type radius_km:    float
+    :param limit:       Most results to return
+    :type limit:        int
+    :return:            (listing, distance in km) pairs
+    :rtype:             list of tuple
+    """
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    dlon = dlat / max(math.cos(math.radians(latitude)), 1e-6)
+    candidates = _in_cells(queryset, covering_cells(latitude - dlat, longitude - dlon,
+                                                    latitude + dlat, longitude + dlon)) \
+        .select_related('property')
+    results = []
+    for listing in candidates:
+        distance = haversine_km(latitude, longitude,
+                                listing.property.latitude, listing.property.longitude)
+        if distance <= radius_km:
+            results.append((listing, distance))
+    results.sort(key=lambda result: result[1])
+    return results[:limit] if limit is not None else results
+
+
+class Geocoder(object):
+    """ Interface of address geocoders """
+
+    def geocode(self, address):
+        """ Locate a property's address
+
+        :param address:     The property, or any Addressable
+        :type address:      ns_helpers.helpers.Addressable
+        :return:            (latitude, longitude), or None if not found
+        :rtype:             tuple of float
+        """
+        raise NotImplementedError
+
+
+class OfflineGeocoder(Geocoder):
+    """ Locates addresses by their zip code's centroid, from a local file
+
+    The GEOCODER_ZIP_CENTROIDS setting names a CSV file with ``zip``,
+    ``latitude`` and ``longitude`` columns.  Without it nothing is found.
+    """
+    def __init__(self, path=None):
+        self.path = path or getattr(settings, 'GEOCODER_ZIP_CENTROIDS', None)
+        self._centroids = None
+
+    def geocode(self, address):
+        if self._centroids is None:
+            self._centroids = {}
+            if self.path:
+                with open(self.path) as f:
+                    for row in csv.DictReader(f):
+                        self._centroids[row['zip'].strip()] = (float(row['latitude']),
+                                                               float(row['longitude']))
+        return self._centroids.get(str(address.zip).strip()[:5])
+
+
+_geocoder = []
+
+
+def get_geocoder():
+    """ Get the geocoder named by the PROPERTY_GEOCODER setting
+
+    Defaults to OfflineGeocoder.
+
+    :rtype:     Geocoder
+    """
+    if not _geocoder:
+        path = getattr(settings, 'PROPERTY_GEOCODER', None)
+        _geocoder.append(import_string(path)() if path else OfflineGeocoder())
+    return _geocoder[0]
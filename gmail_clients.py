@@ -0,0 +1,122 @@
+"""
+GMail Clients
+*************
+
+Authorized GMail API clients, built from a discovery document fetched once
+per process and pooled per mailbox so their connections and tokens are
+reused.  Code holding a client checks it out of the pool for as long as it
+uses it::
+
+    with service_pool.client(credential) as service:
+        execute(service.users().getProfile(userId='me'))
+
+"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+import threading
+
+from apiclient.discovery import build_from_document
+from django.conf import settings
+import httplib2
+
+from .caching import LRUCache
+
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/{api}/{apiVersion}/rest'
+
+_discovery = {}
+_discovery_lock = threading.Lock()
+
+
+def discovery_document():
+    """ Get the GMail v1 discovery document, fetching it once per process
+
+    The GMAIL_DISCOVERY_URL setting points at another API server, such as a
+    local fake for testing.
+
+    :return:    The discovery document
+    :rtype:     str
+    """
+    with _discovery_lock:
+        if 'gmail' not in _discovery:
+            url = getattr(settings, 'GMAIL_DISCOVERY_URL', None) or DISCOVERY_URL
+            url = url.replace('{api}', 'gmail').replace('{apiVersion}', 'v1')
+            response, content = httplib2.Http().request(url)
+            if response.status != 200:
+                raise IOError("Fetching %s failed with %s" % (url, response.status))
+            # Fail here rather than in every client build
+            json.loads(content)
+            _discovery['gmail'] = content
+        return _discovery['gmail']
+
+
+def build_service(credential):
+    """ Build an authorized GMail API client from the cached discovery document
+
+    :param credential:  OAuth credential of the mailbox
+    :type credential:   oauth2client.client.OAuth2Credentials
+    :return:            GMail API service
+    """
+    http = credential.authorize(httplib2.Http())
+    return build_from_document(discovery_document(), http=http)
+
+
+class GMailServicePool(object):
+    """ Per-process LRU pool of authorized GMail clients
+
+    An authorized Http object must not be used by two threads at once, so a
+    client is checked out of the pool while in use and checked back in after.
+    Idle clients are kept per mailbox, as many as were ever used at once, so
+    any thread syncing the mailbox later reuses them.  Access tokens about to
+    expire are refreshed before a client is handed out, so requests do not
+    stall on a 401 and a refresh round trip.
+    """
+    def __init__(self, maxsize=256, refresh_margin=timedelta(minutes=5)):
+        """
+        :param maxsize:         Mailboxes whose idle clients are kept
+        :type maxsize:          int
+        :param refresh_margin:  Refresh tokens expiring within this time
+        :type refresh_margin:   datetime.timedelta
+        """
+        self.refresh_margin = refresh_margin
+        self.clients = LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(credential):
+        return credential.client_id, credential.refresh_token or credential.access_token
+
+    @contextmanager
+    def client(self, credential):
+        """ Check out a client for a mailbox's credential
+
+        :param credential:  OAuth credential of the mailbox
+        :type credential:   oauth2client.client.OAuth2Credentials
+        :return:            Context manager giving a GMail API service, which
+                            is returned to the pool on exit
+        """
+        key = self._key(credential)
+        with self._lock:
+            idle = self.clients.get(key)
+            entry = idle.pop() if idle else None
+        if entry is None:
+            entry = (credential, build_service(credential))
+        pooled_credential, service = entry
+        expiry = pooled_credential.token_expiry
+        if pooled_credential.access_token_expired or \
+                (expiry is not None and expiry - datetime.utcnow() < self.refresh_margin):
+            # Refreshing also saves the new token when the credential has a store
+            pooled_credential.refresh(httplib2.Http())
+        try:
+            yield service
+        finally:
+            with self._lock:
+                idle = self.clients.get(key)
+                if idle is None:
+                    idle = []
+                    self.clients.set(key, idle)
+                idle.append(entry)
+
+
+#: Process-wide GMail client pool
+service_pool = GMailServicePool(maxsize=getattr(settings, 'GMAIL_CLIENT_POOL_SIZE', 256))
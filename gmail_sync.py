@@ -0,0 +1,499 @@
+"""
+GMail Sync
+**********
+
+Background synchronization of GMail mailboxes into Message rows.  The first
+sync of a mailbox lists its most recent messages; later syncs only fetch the
+messages added since the stored history id.
+
+"""
+import base64
+from datetime import datetime
+try:
+    from email.feedparser import BytesFeedParser as FeedParser
+except ImportError:
+    from email.feedparser import FeedParser  # Python 2
+from email.header import decode_header, make_header
+import logging
+from multiprocessing.pool import ThreadPool
+import random
+import threading
+import time
+
+from apiclient.errors import HttpError
+from dateutil.parser import parse
+from django.conf import settings
+from django.utils import six, timezone
+from oauth2client.django_orm import Storage
+from unified_messages.models import GMailCredential
+from user_profiles.models import UserProfile
+
+from .gmail_clients import service_pool
+from .ingestion import existing_external_ids, ingest_emails
+from .models import GMailSyncCheckpoint
+
+
+#: HTTP statuses worth retrying: rate limiting and server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def execute(request, retries=5, backoff=1.0):
+    """ Execute an API request, retrying with exponential backoff
+
+    :param request:     The API request
+    :type request:      apiclient.http.HttpRequest
+    :param retries:     Retries before giving up
+    :type retries:      int
+    :param backoff:     Seconds to wait before the first retry, doubled for
+                        each one after it
+    :type backoff:      float
+    :return:            The response
+    :rtype:             dict
+    """
+    attempt = 0
+    while True:
+        try:
+            return request.execute()
+        except HttpError as e:
+            if e.resp.status not in RETRY_STATUSES or attempt >= retries:
+                raise
+        delay = backoff * 2 ** attempt
+        time.sleep(delay + random.uniform(0, delay))
+        attempt += 1
+
+
+def get_raw_message(service, user_id, msg_id, retries=5):
+    """ Get a gmail message in its base64url-encoded raw form
+
+    :param service:     GMail API service
+    :param user_id:     Mailbox to read, 'me' for the authorized user
+    :type user_id:      str
+    :param msg_id:      GMail message id
+    :type msg_id:       str
+    :param retries:     Retries on rate limiting and server errors
+    :type retries:      int
+    :return:            The encoded RFC 2822 message
+    :rtype:             str
+    """
+    message = execute(service.users().messages().get(userId=user_id, id=msg_id,
+                                                     format='raw'),
+                      retries=retries)
+    return message['raw']
+
+
+def parse_raw_message(raw, chunk_size=64 * 1024):
+    """ Parse a base64url-encoded message without decoding it all at once
+
+    The message is decoded and fed to the parser in chunks, so the decoded
+    copy never exists in full next to the parsed one.
+
+    :param raw:         The encoded RFC 2822 message
+    :type raw:          str
+    :param chunk_size:  Encoded characters decoded per step, a multiple of 4
+    :type chunk_size:   int
+    :return:            The parsed message
+    :rtype:             email.message.Message
+    """
+    parser = FeedParser()
+    for start in range(0, len(raw), chunk_size):
+        chunk = raw[start:start+chunk_size]
+        chunk += "=" * (-len(chunk) % 4)
+        parser.feed(base64.urlsafe_b64decode(chunk.encode('ASCII')))
+    return parser.close()
+
+
+def get_message(service, user_id, msg_id):
+    """ Get a gmail message
+
+    :param service:     GMail API service
+    :param user_id:     Mailbox to read, 'me' for the authorized user
+    :type user_id:      str
+    :param msg_id:      GMail message id
+    :type msg_id:       str
+    :return:            The parsed message
+    :rtype:             email.message.Message
+    """
+    return parse_raw_message(get_raw_message(service, user_id, msg_id))
+
+
+class FetchStats(object):
+    """ Thread-safe throughput counters of message fetching """
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+
+    def rate(self):
+        """ Get the messages fetched per second since creation
+
+        :rtype:     float
+        """
+        elapsed = time.time() - self.started
+        return self.messages / elapsed if elapsed > 0 else 0.
+
+
+class MessageFetcher(object):
+    """ Fetches raw messages over a bounded pool of authorized clients
+
+    API clients are not thread-safe, so each fetch checks one out of the
+    client pool and returns it when done.  Messages that may fetch on a later try, after rate limiting, server or
+    network errors outlasting the retries, are listed in ``failed``.
+    """
+    def __init__(self, client_factory, credential, concurrency=4, retries=5):
+        """
+        :param client_factory:      Checks out an API service for a
+                                    credential, as a context manager
+        :type client_factory:       callable
+        :param credential:          OAuth credential of the mailbox
+        :type credential:           oauth2client.client.OAuth2Credentials
+        :param concurrency:         Requests in flight at once
+        :type concurrency:          int
+        :param retries:             Retries on rate limiting and server errors
+        :type retries:              int
+        """
+        self.client_factory = client_factory
+        self.credential = credential
+        self.concurrency = concurrency
+        self.retries = retries
+        self.stats = FetchStats()
+        self.failed = []
+        self._failed_lock = threading.Lock()
+
+    def _fetch(self, message_id):
+        try:
+            with self.client_factory(self.credential) as service:
+                raw = get_raw_message(service, 'me', message_id, retries=self.retries)
+        except HttpError as e:
+            if e.resp.status == 404:
+                # Deleted drafts and spam still show up in the history
+                logging.debug("GMail message %s no longer exists" % message_id)
+                return message_id, None
+            if e.resp.status not in RETRY_STATUSES:
+                logging.exception("Fetching GMail message %s failed" % message_id)
+                return message_id, None
+            self._fail(message_id)
+            return message_id, None
+        except Exception:
+            self._fail(message_id)
+            return message_id, None
+        self.stats.add(len(raw))
+        return message_id, raw
+
+    def _fail(self, message_id):
+        logging.exception("Fetching GMail message %s failed, retrying next pass" %
+                          message_id)
+        with self._failed_lock:
+            self.failed.append(message_id)
+
+    def fetch(self, message_ids):
+        """ Fetch raw messages concurrently
+
+        :param message_ids:     GMail message ids
+        :type message_ids:      list of str
+        :return:                (message id, raw message) pairs, in
+                                completion order.  The raw message is None
+                                when it could not be fetched.
+        :rtype:                 generator of tuple
+        """
+        if self.concurrency <= 1 or len(message_ids) <= 1:
+            for message_id in message_ids:
+                yield self._fetch(message_id)
+            return
+
+        pool = ThreadPool(min(self.concurrency, len(message_ids)))
+        try:
+            for result in pool.imap_unordered(self._fetch, message_ids):
+                yield result
+        finally:
+            pool.terminate()
+
+
+#: Appended to bodies cut at the size cap
+TRUNCATION_MARKER = "\n\n[Message truncated]"
+
+
+def decode_part(part):
+    """ Get the text of a message part, decoded with its charset
+
+    :param part:    A non-multipart message part
+    :type part:     email.message.Message
+    :rtype:         unicode
+    """
+    payload = part.get_payload(decode=True) or b""
+    try:
+        return payload.decode(part.get_content_charset() or 'utf-8', 'replace')
+    except LookupError:
+        return payload.decode('utf-8', 'replace')
+
+
+def decode_subject(value):
+    """ Get the text of a possibly RFC 2047 encoded header
+
+    :param value:   The raw header, if any
+    :type value:    str
+    :rtype:         unicode
+    """
+    if not value:
+        return u""
+    try:
+        return six.text_type(make_header(decode_header(value)))
+    except (LookupError, UnicodeError, ValueError):
+        return six.text_type(value)
+
+
+def parse_email(msg, max_body_size=None):
+    """ Extract the Message fields of an email
+
+    Only text/plain parts are decoded, each with its own charset.  Other
+    parts, attachments included, are summarized as metadata without touching
+    their payload.
+
+    :param msg:             The parsed message
+    :type msg:              email.message.Message
+    :param max_body_size:   Characters of body kept, GMAIL_MAX_BODY_SIZE by
+                            default.  Longer bodies are cut and marked.
+    :type max_body_size:    int
+    :return:                sender, recipients, subject, created_date and body,
+                            plus a list of attachment metadata dicts with
+                            content_type, filename and approximate size
+    :rtype:                 dict
+    """
+    if max_body_size is None:
+        max_body_size = getattr(settings, 'GMAIL_MAX_BODY_SIZE', 256 * 1024)
+
+    recipients = " ".join(value for value in (msg['to'], msg['cc']) if value)
+    try:
+        created_date = parse(msg['Date'])
+    except Exception:
+        created_date = datetime.now()
+
+    parts = []
+    size = 0
+    attachments = []
+    if msg.is_multipart():
+        for part in msg.walk():
+            if part.is_multipart():
+                continue
+            filename = part.get_filename()
+            if part.get_content_type() == "text/plain" and filename is None:
+                if size <= max_body_size:
+                    text = decode_part(part)
+                    parts.append(text)
+                    size += len(text)
+            else:
+                encoded = part.get_payload()
+                attachments.append({'content_type': part.get_content_type(),
+                                    'filename': filename,
+                                    'size': len(encoded) * 3 // 4
+                                    if part['Content-Transfer-Encoding'] == 'base64'
+                                    else len(encoded)})
+        body = u"".join(parts)
+    else:
+        body = decode_part(msg)
+
+    if len(body) > max_body_size:
+        body = body[:max_body_size] + TRUNCATION_MARKER
+
+    return {'sender': msg['from'], 'recipients': recipients,
+            'subject': decode_subject(msg['subject']),
+            'created_date': created_date, 'body': body,
+            'attachments': attachments}
+
+
+class GMailSyncWorker(object):
+    """ Syncs every linked GMail mailbox, one pass at a time """
+
+    def __init__(self, client_factory=service_pool.client, initial_messages=100,
+                 concurrency=None, retries=5):
+        """
+        :param client_factory:      Checks out an API service for a
+                                    credential, as a context manager
+        :type client_factory:       callable
+        :param initial_messages:    Messages fetched on a mailbox's first sync
+        :type initial_messages:     int
+        :param concurrency:         Messages fetched at once per mailbox,
+                                    GMAIL_FETCH_CONCURRENCY by default
+        :type concurrency:          int
+        :param retries:             Retries of a message fetch on rate
+                                    limiting and server errors
+        :type retries:              int
+        """
+        self.client_factory = client_factory
+        self.initial_messages = initial_messages
+        self.retries = retries
+        if concurrency is None:
+            concurrency = getattr(settings, 'GMAIL_FETCH_CONCURRENCY', 4)
+        self.concurrency = concurrency
+
+    def sync_all(self):
+        """ Sync every mailbox with a valid credential
+
+        A failing mailbox is logged and skipped so it cannot stall the rest.
+
+        :return:    Number of messages stored
+        :rtype:     int
+        """
+        stored = 0
+        for row in GMailCredential.objects.all():
+            credential = row.credential
+            if credential is None or credential.invalid is True:
+                continue
+            # Lets token refreshes be saved back to the row
+            credential.set_store(Storage(GMailCredential, 'id', row.pk, 'credential'))
+            try:
+                stored += self.sync_user(row.pk, credential)
+            except Exception:
+                logging.exception("GMail sync failed for user %s" % row.pk)
+        return stored
+
+    def sync_user(self, user_id, credential):
+        """ Sync one mailbox from its checkpoint
+
+        The checkpoint only moves past the synced history once every message
+        is stored or known to be unstorable.  Otherwise the same history is
+        synced again on the next pass, which skips the stored messages.
+
+        :param user_id:     The mailbox owner's user id
+        :type user_id:      int
+        :param credential:  OAuth credential of the mailbox
+        :type credential:   oauth2client.client.OAuth2Credentials
+        :return:            Number of messages stored
+        :rtype:             int
+        """
+        checkpoint, _ = GMailSyncCheckpoint.objects.get_or_create(user_id=user_id)
+        user_profile = UserProfile.objects.get(user=user_id)
+
+        message_ids = None
+        history_id = checkpoint.history_id
+        with self.client_factory(credential) as service:
+            if history_id:
+                try:
+                    message_ids, history_id = self.get_changes(service, history_id)
+                except HttpError as e:
+                    # History ids expire after about a week
+                    if e.resp.status != 404:
+                        raise
+                    logging.info("GMail history %s expired for user %s" % (history_id,
+                                                                           user_id))
+            if message_ids is None:
+                message_ids, history_id = self.get_recent(service)
+
+        fetcher = MessageFetcher(self.client_factory, credential,
+                                 concurrency=self.concurrency, retries=self.retries)
+        stored = self.store_messages(fetcher, user_profile, message_ids)
+        if fetcher.failed:
+            logging.warning("%d GMail messages of user %s will be fetched again" %
+                            (len(fetcher.failed), user_id))
+        else:
+            checkpoint.history_id = history_id
+        checkpoint.last_synced = timezone.now()
+        checkpoint.save()
+        logging.info("Fetched %d GMail messages for user %s at %.1f/s" %
+                     (fetcher.stats.messages, user_id, fetcher.stats.rate()))
+        return stored
+
+    def get_changes(self, service, history_id):
+        """ Get the ids of messages added since a history id
+
+        :return:    Message ids and the latest history id
+        :rtype:     tuple
+        """
+        message_ids = []
+        request = service.users().history().list(userId='me',
+                                                 startHistoryId=history_id,
+                                                 historyTypes='messageAdded')
+        while request is not None:
+            response = execute(request)
+            for record in response.get('history', ()):
+                message_ids.extend(added['message']['id']
+                                   for added in record.get('messagesAdded', ()))
+            history_id = response.get('historyId', history_id)
+            request = service.users().history().list_next(request, response)
+        return message_ids, history_id
+
+    def get_recent(self, service):
+        """ Get the ids of the most recent messages of a mailbox
+
+        The history id is read first, so nothing added while listing is lost.
+
+        :return:    Message ids and the history id to continue from
+        :rtype:     tuple
+        """
+        history_id = execute(service.users().getProfile(userId='me'))['historyId']
+        message_ids = []
+        request = service.users().messages().list(userId='me',
+                                                  maxResults=min(self.initial_messages,
+                                                                 500))
+        while request is not None and len(message_ids) < self.initial_messages:
+            response = execute(request)
+            message_ids.extend(message['id'] for message in response.get('messages', ()))
+            request = service.users().messages().list_next(request, response)
+        return message_ids[:self.initial_messages], history_id
+
+    def store_messages(self, fetcher, user_profile, message_ids):
+        """ Fetch and store the messages that are not stored yet
+
+        Messages that no longer exist or cannot be parsed are logged and
+        skipped.  The ones that failed to fetch are left in
+        ``fetcher.failed``.
+
+        :param fetcher:         Fetcher for the user's mailbox
+        :type fetcher:          MessageFetcher
+        :param user_profile:    The mailbox owner
+        :type user_profile:     UserProfile
+        :param message_ids:     GMail message ids
+        :type message_ids:      list of str
+        :return:                Number of messages stored
+        :rtype:                 int
+        """
+        existing = existing_external_ids(user_profile, message_ids)
+        new_ids = []
+        for message_id in message_ids:
+            if message_id not in existing:
+                existing.add(message_id)
+                new_ids.append(message_id)
+
+        parsed = (self.parse_fetched(user_profile, message_id, raw)
+                  for message_id, raw in fetcher.fetch(new_ids) if raw is not None)
+        return ingest_emails(user_profile, (fields for fields in parsed if fields is not None))
+
+    @staticmethod
+    def parse_fetched(user_profile, message_id, raw):
+        """ Parse a fetched message into create_email arguments
+
+        :return:    The arguments, or None if the message cannot be parsed
+        :rtype:     dict
+        """
+        try:
+            fields = parse_email(parse_raw_message(raw))
+        except Exception:
+            logging.exception("Parsing GMail message %s failed" % message_id)
+            return None
+        for attachment in fields.pop('attachments'):
+            logging.debug("Skipped attachment of message %s: %s" % (message_id,
+                                                                   attachment))
+        if not all(fields[key] for key in ('created_date', 'sender',
+                                           'recipients', 'subject')):
+            logging.debug("Invalid email.  User: %s, ID: %s" % (user_profile,
+                                                                message_id))
+        fields['externalId'] = message_id
+        return fields
+
+    def run_forever(self, interval=60):
+        """ Sync all mailboxes every ``interval`` seconds
+
+        :param interval:    Seconds between the start of two passes
+        :type interval:     int
+        """
+        while True:
+            started = time.time()
+            stored = self.sync_all()
+            logging.info("GMail sync stored %d messages" % stored)
+            time.sleep(max(0, interval - (time.time() - started)))
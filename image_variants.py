@@ -0,0 +1,312 @@
+"""
+Image Variants
+**************
+
+Thumbnails and web-optimized variants of property images, generated once per
+original and kept in a content-addressed, size-bounded local cache.
+Requires Pillow.
+
+Layout under the cache root::
+
+    links/<sha1 of url>             content hash of the url's original
+    originals/<ab>/<content hash>   the fetched original
+    variants/<ab>/<content hash>-<variant>.jpg
+
+"""
+import errno
+import hashlib
+import io
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import tempfile
+import threading
+
+from django.conf import settings
+from django.utils.six.moves.urllib.parse import urlparse
+from django.utils.six.moves.urllib.request import urlopen
+
+#: Variant name -> (width, height, crop to fill instead of fitting inside)
+VARIANTS = {
+    'thumb': (240, 180, True),
+    'medium': (800, 600, False),
+    'large': (1600, 1200, False),
+}
+
+JPEG_QUALITY = 82
+
+#: Url schemes originals are fetched from
+FETCH_SCHEMES = ('http', 'https')
+
+
+def _hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def check_url(url):
+    """ Make sure an original's url is one the server may fetch
+
+    Links are stored unchecked, and fetching file: or other urls would
+    expose the server's own files to anyone viewing an image.
+
+    :param url:         Location of the original
+    :type url:          str
+    :raises ValueError: If the url is not http or https
+    """
+    if urlparse(url or '').scheme.lower() not in FETCH_SCHEMES:
+        raise ValueError("Not an http or https url: %r" % url)
+
+
+def render_variant(data, variant):
+    """ Render a variant of an image
+
+    :param data:        The original image
+    :type data:         bytes
+    :param variant:     Name of a variant in VARIANTS
+    :type variant:      str
+    :return:            The variant as a progressive JPEG
+    :rtype:             bytes
+    """
+    from PIL import Image, ImageOps
+
+    width, height, crop = VARIANTS[variant]
+    # Phone cameras store rotation as EXIF orientation rather than rotated pixels
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    if crop:
+        image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+    else:
+        image.thumbnail((width, height), Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+class ImageVariantCache(object):
+    """ Content-addressed cache of originals and their variants
+
+    Files are touched when used, and the least recently used ones are evicted
+    in the background once the cache outgrows ``max_bytes``.
+    """
+    def __init__(self, root, max_bytes, timeout=30):
+        """
+        :param root:        Cache directory
+        :type root:         str
+        :param max_bytes:   Size the cache is trimmed to
+        :type max_bytes:    int
+        :param timeout:     Seconds to wait for an origin server
+        :type timeout:      int
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._evict_lock = threading.Lock()
+        # Bytes in the cache as of the last eviction plus those written since,
+        # None until the first eviction has measured it
+        self._size = None
+
+    def _path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def _write(self, path, data):
+        """ Write a file atomically, so readers never see a partial one """
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+        if self._size is not None:
+            self._size += len(data)
+        if self._size is None or self._size > self.max_bytes:
+            self._evict_soon()
+
+    def _evict_soon(self):
+        """ Start an eviction in the background unless one is running """
+        if self._evict_lock.acquire(False):
+            self._evict_lock.release()
+            thread = threading.Thread(target=self.evict)
+            thread.daemon = True
+            thread.start()
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        os.utime(path, None)
+        return data
+
+    def _link(self, url):
+        return self._path('links', _hash(url.encode('utf-8')))
+
+    def linked_hash(self, url):
+        """ Get the content hash a url was last fetched with
+
+        :param url:     Location of the original
+        :type url:      str
+        :return:        Content hash, or None if never fetched
+        :rtype:         str
+        """
+        digest = self._read(self._link(url))
+        return digest.decode('ascii') if digest is not None else None
+
+    def content_hash(self, url):
+        """ Get the content hash of a url's original, fetching it if needed
+
+        :param url:     Location of the original
+        :type url:      str
+        :return:        Content hash of the original
+        :rtype:         str
+        :raises ValueError: If the url is not http or https
+        """
+        check_url(url)
+        digest = self.linked_hash(url)
+        if digest is not None and \
+                os.path.exists(self._path('originals', digest[:2], digest)):
+            return digest
+
+        response = urlopen(url, timeout=self.timeout)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+        digest = _hash(data)
+        self._write(self._path('originals', digest[:2], digest), data)
+        self._write(self._link(url), digest.encode('ascii'))
+        return digest
+
+    def variant_path(self, url, variant):
+        """ Get the file of a variant, generating it if needed
+
+        :param url:         Location of the original
+        :type url:          str
+        :param variant:     Name of a variant in VARIANTS
+        :type variant:      str
+        :return:            Content hash of the original and path of the
+                            variant file
+        :rtype:             tuple
+        :raises KeyError:   If the variant is unknown
+        :raises ValueError: If the url is not http or https
+        """
+        if variant not in VARIANTS:
+            raise KeyError(variant)
+        check_url(url)
+        digest = self.linked_hash(url)
+        if digest is not None:
+            path = self._variant(digest, variant)
+            if os.path.exists(path):
+                os.utime(path, None)
+                return digest, path
+
+        digest = self.content_hash(url)
+        path = self._variant(digest, variant)
+        if not os.path.exists(path):
+            original = self._read(self._path('originals', digest[:2], digest))
+            self._write(path, render_variant(original, variant))
+        return digest, path
+
+    def open_variant(self, url, variant):
+        """ Open the file of a variant, generating it if needed
+
+        A file evicted between being located and opened is generated again.
+
+        :param url:         Location of the original
+        :type url:          str
+        :param variant:     Name of a variant in VARIANTS
+        :type variant:      str
+        :return:            Content hash of the original and the open file
+        :rtype:             tuple
+        :raises KeyError:   If the variant is unknown
+        :raises ValueError: If the url is not http or https
+        """
+        digest, path = self.variant_path(url, variant)
+        try:
+            return digest, open(path, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        digest, path = self.variant_path(url, variant)
+        return digest, open(path, 'rb')
+
+    def _variant(self, digest, variant):
+        return self._path('variants', digest[:2], "%s-%s.jpg" % (digest, variant))
+
+    def warm(self, urls, workers=4):
+        """ Generate every variant of many originals on a worker pool
+
+        :param urls:        Locations of the originals
+        :type urls:         iterable of str
+        :param workers:     Originals processed at once
+        :type workers:      int
+        :return:            Number of originals processed without error
+        :rtype:             int
+        """
+        def process(url):
+            try:
+                for variant in VARIANTS:
+                    self.variant_path(url, variant)
+                return True
+            except Exception:
+                logging.exception("Rendering variants of %s failed" % url)
+                return False
+
+        pool = ThreadPool(workers)
+        try:
+            done = sum(pool.imap_unordered(process, urls))
+        finally:
+            pool.close()
+            pool.join()
+        self.evict()
+        return done
+
+    def evict(self):
+        """ Delete the least recently used files until under max_bytes
+
+        :return:    Bytes freed
+        :rtype:     int
+        """
+        with self._evict_lock:
+            files = []
+            total = 0
+            for directory in ('originals', 'variants'):
+                for dirpath, _, filenames in os.walk(self._path(directory)):
+                    for filename in filenames:
+                        path = os.path.join(dirpath, filename)
+                        stat = os.stat(path)
+                        files.append((stat.st_mtime, stat.st_size, path))
+                        total += stat.st_size
+            freed = 0
+            files.sort()
+            for _, size, path in files:
+                if total - freed <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    freed += size
+                except OSError:
+                    pass
+            self._size = total - freed
+            return freed
+
+    def clear(self):
+        """ Delete the whole cache """
+        shutil.rmtree(self.root, ignore_errors=True)
+        self._size = None
+
+
+#: Process-wide cache, configured by the PROPERTY_IMAGE_CACHE_DIR and
+#: PROPERTY_IMAGE_CACHE_BYTES settings
+image_cache = ImageVariantCache(
+    getattr(settings, 'PROPERTY_IMAGE_CACHE_DIR',
+            os.path.join(tempfile.gettempdir(), 'property-images')),
+    getattr(settings, 'PROPERTY_IMAGE_CACHE_BYTES', 2 * 1024 ** 3))
@@ -0,0 +1,137 @@
+"""
+Message Ingestion
+*****************
+
+Batched, idempotent storage of messages fetched from external services.
+
+Each chunk of messages is stored in one transaction: stored external ids are
+filtered out with one query and the rest is inserted with one bulk_create.
+Message has no unique index on (user_profile, external_id), so the owner's
+UserProfile row is locked for the transaction instead.  Syncs of the same
+account therefore store their chunks one after the other, and each sees the
+messages the other stored.
+
+"""
+from django.db import transaction
+from unified_messages.models import Message
+from user_profiles.models import UserProfile
+
+from .models import MessageAddress
+
+
+def existing_external_ids(user_profile, external_ids):
+    """ Get which external ids are already stored for a user
+
+    :param user_profile:    The messages' owner
+    :type user_profile:     UserProfile
+    :param external_ids:    Ids assigned by the external service
+    :type external_ids:     list
+    :return:                The stored ids, as strings
+    :rtype:                 set of str
+    """
+    return set(str(external_id) for external_id in
+               Message.objects.filter(user_profile=user_profile,
+                                      external_id__in=external_ids)
+               .values_list('external_id', flat=True))
+
+
+def _message_type(name):
+    return Message._meta.get_field('type').rel.to.objects.get(name=name)
+
+
+def _email(user_profile, message_type, externalId, created_date, sender, recipients,
+           subject, body):
+    """ Build an unsaved email, as Message.objects.create_email would """
+    return Message(user_profile=user_profile, type=message_type, external_id=externalId,
+                   creation_date=created_date, sender=sender, recipients=recipients,
+                   headline=subject, body=body)
+
+
+def _tweet(user_profile, message_type, externalId, created_date, sender, body):
+    """ Build an unsaved tweet, as Message.objects.create_tweet would """
+    return Message(user_profile=user_profile, type=message_type, external_id=externalId,
+                   creation_date=created_date, sender=sender, body=body)
+
+
+def _ingest(user_profile, messages, build, type_name, batch_size):
+    """ Store the new messages of a batch, chunk by chunk
+
+    :param messages:    Keyword arguments for ``build``, each with an
+                        ``externalId``
+    :type messages:     iterable of dict
+    :param build:       Builds one unsaved message
+    :type build:        callable
+    :param type_name:   Name of the messages' type
+    :type type_name:    str
+    :return:            Number of messages stored
+    :rtype:             int
+    """
+    message_type = _message_type(type_name)
+    stored = 0
+    seen = set()
+    chunk = []
+    for message in messages:
+        chunk.append(message)
+        if len(chunk) >= batch_size:
+            stored += _ingest_chunk(user_profile, chunk, build, message_type, seen)
+            chunk = []
+    if chunk:
+        stored += _ingest_chunk(user_profile, chunk, build, message_type, seen)
+    return stored
+
+
+def _ingest_chunk(user_profile, chunk, build, message_type, seen):
+    with transaction.atomic():
+        # One writer per owner, held until the chunk is committed
+        list(UserProfile.objects.select_for_update().filter(pk=user_profile.pk)
+             .values_list('pk', flat=True))
+        seen.update(existing_external_ids(user_profile,
+                                          [message['externalId'] for message in chunk]))
+        new = []
+        for message in chunk:
+            external_id = str(message['externalId'])
+            if external_id in seen:
+                continue
+            seen.add(external_id)
+            new.append(build(user_profile, message_type, **message))
+        if not new:
+            return 0
+        # bulk_create sends no post_save, so index the addresses here
+        Message.objects.bulk_create(new)
+        MessageAddress.objects.index(
+            Message.objects.filter(user_profile=user_profile,
+                                   external_id__in=[message.external_id for message in new])
+            .only('pk', 'sender', 'recipients'))
+    return len(new)
+
+
+def ingest_emails(user_profile, emails, batch_size=500):
+    """ Store the emails of a batch that are not stored yet
+
+    :param user_profile:    The mailbox owner
+    :type user_profile:     UserProfile
+    :param emails:          create_email keyword arguments: externalId,
+                            created_date, sender, recipients, subject and body
+    :type emails:           iterable of dict
+    :param batch_size:      Messages checked and stored per transaction
+    :type batch_size:       int
+    :return:                Number of emails stored
+    :rtype:                 int
+    """
+    return _ingest(user_profile, emails, _email, "Email", batch_size)
+
+
+def ingest_tweets(user_profile, tweets, batch_size=500):
+    """ Store the tweets of a batch that are not stored yet
+
+    :param user_profile:    The timeline owner
+    :type user_profile:     UserProfile
+    :param tweets:          create_tweet keyword arguments: externalId,
+                            created_date, sender and body
+    :type tweets:           iterable of dict
+    :param batch_size:      Messages checked and stored per transaction
+    :type batch_size:       int
+    :return:                Number of tweets stored
+    :rtype:                 int
+    """
+    return _ingest(user_profile, tweets, _tweet, "Tweet", batch_size)
@@ -0,0 +1,157 @@
+"""
+Listing Search
+**************
+
+In-memory columnar index of active property listings, for multi-criteria
+search, facet counts and keyset pagination without a database round trip.
+Requires NumPy.
+
+"""
+from django.conf import settings
+import numpy as np
+
+from .caching import SharedIndex
+from .models import LISTING_INDEX_VERSION, PropertyListing, PropertyProfile
+from .pagination import decode_cursor, encode_cursor
+
+TYPES = [code for code, _ in PropertyProfile._meta.get_field('type').choices]
+PARKING = [code for code, _ in PropertyProfile._meta.get_field('parking').choices]
+
+#: Facets computed by ListingIndex.facets, and how their values are labelled
+FACETS = {
+    'type': lambda code: TYPES[code],
+    'parking': lambda code: PARKING[code],
+    'bedrooms': int,
+    'allow_pets': bool,
+    'furnished': bool,
+}
+
+
+class ListingIndex(SharedIndex):
+    """ Columns of every active listing, sorted by rent and id
+
+    Loaded on first use and reloaded lazily after a listing or profile is
+    saved or deleted in any process, which the signals in models.py report.
+    """
+    version_key = LISTING_INDEX_VERSION
+
+    def __init__(self, **kwargs):
+        super(ListingIndex, self).__init__(**kwargs)
+        self.columns = {}
+
+    def load(self):
+        rows = list(PropertyListing.objects.filter(active=True)
+                    .order_by('rent', 'pk')
+                    .values_list('pk', 'rent', 'allow_pets', 'max_pets',
+                                 'furnished', 'property__profile__type',
+                                 'property__profile__bedrooms',
+                                 'property__profile__baths',
+                                 'property__profile__sqft',
+                                 'property__profile__parking'))
+        columns = list(zip(*rows)) or [()] * 10
+        self.columns = {
+            'id': np.array(columns[0], dtype=np.int64),
+            'rent': np.array([int(round(rent * 100)) for rent in columns[1]],
+                             dtype=np.int64),
+            'allow_pets': np.array(columns[2], dtype=bool),
+            'max_pets': np.array(columns[3], dtype=np.int32),
+            'furnished': np.array(columns[4], dtype=bool),
+            'type': np.array([TYPES.index(code) for code in columns[5]],
+                             dtype=np.int8),
+            'bedrooms': np.array(columns[6], dtype=np.int32),
+            'baths': np.array([float(baths) for baths in columns[7]]),
+            'sqft': np.array(columns[8], dtype=np.int32),
+            'parking': np.array([PARKING.index(code) for code in columns[9]],
+                                dtype=np.int8),
+        }
+
+    def _columns(self):
+        """ Get the current columns, loading them if needed
+
+        The columns dict is replaced as a whole on reload, so callers keep
+        using the one they got even if another thread reloads meanwhile.
+        """
+        self.refresh()
+        return self.columns
+
+    @staticmethod
+    def _mask(c, rent_min=None, rent_max=None, pets=None, furnished=None,
+              types=None, bedrooms_min=None, baths_min=None, sqft_min=None,
+              sqft_max=None, parking=None):
+        """ Select the listings of a columns snapshot matching the criteria of
+        PropertyListingQuerySet.search
+        """
+        mask = np.ones(len(c['id']), dtype=bool)
+        if rent_min is not None:
+            mask &= c['rent'] >= int(round(rent_min * 100))
+        if rent_max is not None:
+            mask &= c['rent'] <= int(round(rent_max * 100))
+        if pets:
+            mask &= c['allow_pets'] & (c['max_pets'] >= pets)
+        if furnished is not None:
+            mask &= c['furnished'] == furnished
+        if types:
+            mask &= np.isin(c['type'], [TYPES.index(code) for code in types])
+        if bedrooms_min is not None:
+            mask &= c['bedrooms'] >= bedrooms_min
+        if baths_min is not None:
+            mask &= c['baths'] >= float(baths_min)
+        if sqft_min is not None:
+            mask &= c['sqft'] >= sqft_min
+        if sqft_max is not None:
+            mask &= c['sqft'] <= sqft_max
+        if parking:
+            mask &= np.isin(c['parking'], [PARKING.index(code) for code in parking])
+        return mask
+
+    def search(self, limit=20, cursor=None, **criteria):
+        """ Get a page of matching listing ids, by rent and then id
+
+        :param limit:       Listings per page
+        :type limit:        int
+        :param cursor:      Cursor returned with the previous page, if any
+        :type cursor:       str
+        :param criteria:    Criteria of PropertyListingQuerySet.search
+        :return:            Listing ids and the cursor of the next page, which
+                            is None on the last page
+        :rtype:             tuple
+        :raises ValueError: If the cursor is malformed
+        """
+        c = self._columns()
+        mask = self._mask(c, **criteria)
+        if cursor:
+            rent, pk = decode_cursor(cursor, 2)
+            mask &= (c['rent'] > rent) | ((c['rent'] == rent) & (c['id'] > pk))
+        rows = np.flatnonzero(mask)[:limit + 1]
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = encode_cursor((c['rent'][last], c['id'][last]))
+        return [int(pk) for pk in c['id'][rows[:limit]]], next_cursor
+
+    def facets(self, **criteria):
+        """ Count the matching listings per value of each facet
+
+        :param criteria:    Criteria of PropertyListingQuerySet.search
+        :return:            Counts keyed by facet, then by facet value
+        :rtype:             dict
+        """
+        columns = self._columns()
+        mask = self._mask(columns, **criteria)
+        counts = {}
+        for facet, label in FACETS.items():
+            values, totals = np.unique(columns[facet][mask], return_counts=True)
+            counts[facet] = dict((label(value), int(total))
+                                 for value, total in zip(values, totals))
+        return counts
+
+    def count(self, **criteria):
+        """ Count the matching listings
+
+        :rtype:     int
+        """
+        return int(self._mask(self._columns(), **criteria).sum())
+
+
+#: Process-wide listing index
+listing_index = ListingIndex(max_age=getattr(settings, 'PROPERTY_INDEX_MAX_AGE', 300))
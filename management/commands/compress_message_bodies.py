@@ -0,0 +1,39 @@
+"""
+Compress stored message bodies
+******************************
+
+"""
+from django.core.management.base import BaseCommand
+from unified_messages.models import Message
+
+from ...body_store import encode_body, is_encoded
+
+
+class Command(BaseCommand):
+    help = "Compress or offload existing message bodies above the size threshold"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Messages read per batch")
+        parser.add_argument('--backend', choices=('blob', 'inline'), default=None,
+                            help="Where to keep compressed bodies "
+                                 "(default: MESSAGE_BODY_BACKEND)")
+
+    def handle(self, *args, **options):
+        converted = 0
+        last_pk = 0
+        while True:
+            batch = list(Message.objects.filter(pk__gt=last_pk).order_by('pk')
+                         .values_list('pk', 'body')[:options['batch_size']])
+            if not batch:
+                break
+            for pk, body in batch:
+                if is_encoded(body):
+                    continue
+                stored = encode_body(body, backend=options['backend'])
+                if stored != body:
+                    Message.objects.filter(pk=pk).update(body=stored)
+                    converted += 1
+            last_pk = batch[-1][0]
+
+        self.stdout.write("Compressed %d message bodies" % converted)
@@ -0,0 +1,31 @@
+"""
+Extend the materialized rent schedule
+*************************************
+
+"""
+from datetime import date
+
+from dateutil.parser import parse
+from django.core.management.base import BaseCommand
+
+from ...models import RentSchedule
+
+
+class Command(BaseCommand):
+    help = "Schedule rent periods of running leases and link their invoices"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--through', default=None,
+                            help="Schedule up to this date (default: today)")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Rows per insert")
+
+    def handle(self, *args, **options):
+        through = parse(options['through']).date() if options['through'] else date.today()
+
+        created = RentSchedule.objects.extend(through,
+                                              batch_size=options['batch_size'])
+        linked = RentSchedule.objects.link_invoices()
+
+        self.stdout.write("Scheduled %d rent periods through %s, linked %d invoices" %
+                          (created, through, linked))
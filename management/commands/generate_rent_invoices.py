@@ -0,0 +1,28 @@
+"""
+Generate monthly rent invoices
+******************************
+
+"""
+from datetime import date
+
+from dateutil.parser import parse
+from django.core.management.base import BaseCommand
+
+from ...billing import generate_rent_invoices
+
+
+class Command(BaseCommand):
+    help = "Create the rent invoices for the upcoming due date of every active lease"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', default=None,
+                            help="Bill as of this date (default: today)")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Invoices per insert")
+
+    def handle(self, *args, **options):
+        today = parse(options['date']).date() if options['date'] else date.today()
+
+        created = generate_rent_invoices(today, batch_size=options['batch_size'])
+
+        self.stdout.write("Created %d rent invoices as of %s" % (created, today))
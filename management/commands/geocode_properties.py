@@ -0,0 +1,32 @@
+"""
+Geocode properties
+******************
+
+"""
+from django.core.management.base import BaseCommand
+
+from ...models import Property
+
+
+class Command(BaseCommand):
+    help = "Fill in coordinates and geohashes of properties"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="Geocode every property, not only unlocated ones")
+
+    def handle(self, *args, **options):
+        properties = Property.objects.all()
+        if not options['all']:
+            properties = properties.filter(latitude__isnull=True)
+
+        located = 0
+        for prop in properties.iterator():
+            prop.locate()
+            if prop.latitude is not None:
+                located += 1
+            Property.objects.filter(pk=prop.pk).update(latitude=prop.latitude,
+                                                       longitude=prop.longitude,
+                                                       geohash=prop.geohash)
+
+        self.stdout.write("Located %d properties" % located)
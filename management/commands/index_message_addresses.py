@@ -0,0 +1,31 @@
+"""
+Index message contact addresses
+*******************************
+
+"""
+from django.core.management.base import BaseCommand
+from unified_messages.models import Message
+
+from ...models import MessageAddress
+
+
+class Command(BaseCommand):
+    help = "Rebuild the normalized sender and recipient index of all messages"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Messages per batch")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        indexed = 0
+        last_pk = 0
+        while True:
+            batch = list(Message.objects.filter(pk__gt=last_pk).order_by('pk')
+                         .only('pk', 'sender', 'recipients')[:batch_size])
+            if not batch:
+                break
+            indexed += MessageAddress.objects.index(batch)
+            last_pk = batch[-1].pk
+
+        self.stdout.write("Indexed %d message addresses" % indexed)
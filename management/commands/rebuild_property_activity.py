@@ -0,0 +1,24 @@
+"""
+Rebuild the materialized activity events
+****************************************
+
+"""
+from django.core.management.base import BaseCommand
+
+from ...models import ACTIVITY_SOURCES, PropertyActivity
+
+
+class Command(BaseCommand):
+    help = "Rebuild the stored activity events from leases, contracts, " \
+           "maintenance requests, messages and invoices"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Events per insert")
+
+    def handle(self, *args, **options):
+        for model in ACTIVITY_SOURCES:
+            stored = PropertyActivity.objects.rebuild(model,
+                                                      batch_size=options['batch_size'])
+            self.stdout.write("Stored %d events for %s" % (stored,
+                                                           model._meta.verbose_name_plural))
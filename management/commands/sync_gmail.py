@@ -0,0 +1,30 @@
+"""
+Sync GMail mailboxes
+********************
+
+"""
+from django.core.management.base import BaseCommand
+
+from ...gmail_sync import GMailSyncWorker
+
+
+class Command(BaseCommand):
+    help = "Fetch new GMail messages of every linked mailbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep syncing instead of running one pass")
+        parser.add_argument('--interval', type=int, default=60,
+                            help="Seconds between passes with --loop")
+        parser.add_argument('--initial-messages', type=int, default=100,
+                            help="Messages fetched on a mailbox's first sync")
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help="Messages fetched at once per mailbox")
+
+    def handle(self, *args, **options):
+        worker = GMailSyncWorker(initial_messages=options['initial_messages'],
+                                 concurrency=options['concurrency'])
+        if options['loop']:
+            worker.run_forever(interval=options['interval'])
+        else:
+            self.stdout.write("Stored %d messages" % worker.sync_all())
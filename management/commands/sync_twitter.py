@@ -0,0 +1,25 @@
+"""
+Sync Twitter timelines
+**********************
+
+"""
+from django.core.management.base import BaseCommand
+
+from ...social_ingest import IngestionEngine, TwitterConnector
+
+
+class Command(BaseCommand):
+    help = "Fetch new tweets of every linked Twitter account"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep syncing instead of running one pass")
+        parser.add_argument('--interval', type=int, default=60,
+                            help="Most seconds between passes with --loop")
+
+    def handle(self, *args, **options):
+        engine = IngestionEngine([TwitterConnector()])
+        if options['loop']:
+            engine.run_forever(interval=options['interval'])
+        else:
+            self.stdout.write("Stored %d tweets" % engine.run_once().get('stored', 0))
@@ -0,0 +1,23 @@
+"""
+Warm the property image variant cache
+*************************************
+
+"""
+from django.core.management.base import BaseCommand
+
+from ...image_variants import image_cache
+from ...models import PropertyImage
+
+
+class Command(BaseCommand):
+    help = "Fetch property images and render their variants"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help="Images processed at once")
+
+    def handle(self, *args, **options):
+        links = PropertyImage.objects.values_list('link', flat=True).distinct()
+        done = image_cache.warm(links.iterator(), workers=options['workers'])
+
+        self.stdout.write("Rendered variants of %d images" % done)
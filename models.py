@@ -5,24 +5,306 @@ Neighborhood Space Data Models
 """
 import calendar
 from datetime import date, timedelta, datetime
+import heapq
+import re
+from itertools import islice
 import logging
+from operator import attrgetter
 
 from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.core.cache import caches
 from django.db import models
-from django.db.models import Q
+from django.db.models import Case, F, Max, Q, Value, When
+from django.core.urlresolvers import reverse
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
 from contracts.models import LeaseContract, ManagementContract
 from finances.models import Invoice, InvoiceType
 from maintenance.models import MaintenanceRequest
 from ns_helpers.helpers import Addressable
-from unified_messages.models import Message
+from unified_messages.models import Message, TwitterAuth
 
 from unit_manager.helpers import angular_sref
 
+from . import body_store
+from .caching import ActivityCache, bump_version
+from .events import ActivityEvent
+from .geo import GEOHASH_PRECISION, geohash_encode, get_geocoder
+from .occupancy import occupancy_index
+from .pagination import (datetime_to_micros, decode_cursor, encode_cursor,
+                         micros_to_datetime)
+
+
+def rent_due_date(year, month, rent_due_day):
+    """ Get the rent due date for a billing month
+
+    The due day is clamped to the last day of the month when the month is too
+    short, e.g. a due day of 31 falls on the 30th in April.
+
+    :param year:            Year of the billing month
+    :type year:             int
+    :param month:           Billing month
+    :type month:            int
+    :param rent_due_day:    Day of the month rent is due
+    :type rent_due_day:     int
+    :return:                The clamped due date
+    :rtype:                 datetime.date
+    """
+    return date(year=year, month=month,
+                day=min(rent_due_day, calendar.monthrange(year, month)[1]))
+
+
+def last_rent_due_date(today, rent_due_day):
+    """ Get the most recent rent due date on or before a date
+
+    :param today:           The date to look back from
+    :type today:            datetime.date
+    :param rent_due_day:    Day of the month rent is due
+    :type rent_due_day:     int
+    :return:                The last clamped due date
+    :rtype:                 datetime.date
+    """
+    this_month_due_date = rent_due_date(today.year, today.month, rent_due_day)
+    if today >= this_month_due_date:
+        return this_month_due_date
+    last_month = today - relativedelta(months=1)
+    return rent_due_date(last_month.year, last_month.month, rent_due_day)
+
+
+def next_rent_due_date(today, rent_due_day):
+    """ Get the first rent due date on or after a date
+
+    :param today:           The date to look ahead from
+    :type today:            datetime.date
+    :param rent_due_day:    Day of the month rent is due
+    :type rent_due_day:     int
+    :return:                The next clamped due date
+    :rtype:                 datetime.date
+    """
+    this_month_due_date = rent_due_date(today.year, today.month, rent_due_day)
+    if today <= this_month_due_date:
+        return this_month_due_date
+    next_month = today + relativedelta(months=1)
+    return rent_due_date(next_month.year, next_month.month, rent_due_day)
+
+
+def rent_due_dates(lease, through):
+    """ Get every rent due date of a lease up to a date
+
+    One due date per billing month, from the month the lease starts in to the
+    month it ends in or the month of ``through``, whichever comes first.
+
+    :param lease:       The lease to schedule
+    :type lease:        LeaseContract
+    :param through:     Last date to schedule up to
+    :type through:      datetime.date
+    :return:            Clamped due dates in ascending order
+    :rtype:             generator of datetime.date
+    """
+    last = min(lease.end_date, through)
+    month = lease.start_date.replace(day=1)
+    while month <= last:
+        yield rent_due_date(month.year, month.month, lease.rent_due_day)
+        month += relativedelta(months=1)
+
+
+def rent_status(lease, today, invoice):
+    """ Get the rent status of a single lease
+
+    :param lease:       The active lease
+    :type lease:        LeaseContract
+    :param today:       The date to use for the calculation
+    :type today:        datetime.date
+    :param invoice:     The rent invoice for the last due date
+    :type invoice:      Invoice
+    :return:            Rent status string
+    :rtype:             str
+    """
+    if invoice.paid_date:
+        return "Paid"
+    last_due = last_rent_due_date(today, lease.rent_due_day)
+    if last_due <= today <= last_due+timedelta(days=lease.days_grace_period):
+        return "Due"
+    return "Late"
+
+
+EMAIL_ADDRESS = re.compile(r'[^\s<>,;"\'()]+@[^\s<>,;"\'()]+')
+PHONE_NUMBER = re.compile(r'^\+?[\d\s().-]{7,}$')
+
+
+def normalize_address(value):
+    """ Normalize a single email address, phone number or handle
+
+    Email addresses and handles are lower-cased, phone numbers are reduced to
+    their digits.
+
+    :param value:   The address as written in a message
+    :type value:    str
+    :return:        The normalized address
+    :rtype:         str
+    """
+    value = value.strip()
+    if PHONE_NUMBER.match(value):
+        return re.sub(r'\D', '', value)
+    return value.lower()
+
+
+def split_addresses(value):
+    """ Split a sender or recipient field into normalized addresses
+
+    Fields may hold several email addresses with display names, separated by
+    commas or spaces, or a single phone number or handle.
+
+    :param value:   The sender or recipients of a message
+    :type value:    str
+    :return:        Normalized addresses
+    :rtype:         set of str
+    """
+    if not value:
+        return set()
+    emails = EMAIL_ADDRESS.findall(value)
+    if emails:
+        return set(normalize_address(address) for address in emails)
+    return set([normalize_address(value)])
+
+
+def collect_roles(owners, managers, tenants):
+    """ Group role memberships into role tuples
+
+    :param owners:      Ids holding the owner role
+    :type owners:       iterable of int
+    :param managers:    Ids holding the manager role
+    :type managers:     iterable of int
+    :param tenants:     Ids holding the tenant role
+    :type tenants:      iterable of int
+    :return:            Role tuples, in get_user_roles order, keyed by id
+    :rtype:             dict
+    """
+    roles = {}
+    for role, ids in (('owner', owners), ('manager', managers), ('tenant', tenants)):
+        for pk in set(ids):
+            roles.setdefault(pk, []).append(role)
+    return dict((pk, tuple(ret)) for pk, ret in roles.items())
+
+
+def role_memo(request):
+    """ Get the role cache for the duration of a request
+
+    Pass it as ``memo`` to Property.get_user_roles so repeated permission
+    checks within the request are answered without queries.
+
+    :param request:     The current request
+    :type request:      django.http.HttpRequest
+    :return:            The request's role cache
+    :rtype:             dict
+    """
+    if not hasattr(request, '_property_roles'):
+        request._property_roles = {}
+    return request._property_roles
+
+
+class PropertyQuerySet(models.QuerySet):
+    """ Portfolio-wide queries over properties """
+
+    def get_vacant(self, today):
+        """ Get the properties without a lease in effect on a date
+
+        Answered from the in-memory occupancy index, so the only query lists
+        the queryset's ids.
+
+        :param today:       The date to check
+        :type today:        datetime.date
+        :return:            Ids of the vacant properties
+        :rtype:             set of int
+        """
+        return occupancy_index.vacant(self.values_list('pk', flat=True), today)
+
+    def get_user_roles(self, user_profile, today):
+        """ Get one user's roles on every property in the queryset
+
+        Uses three queries no matter how many properties are involved.
+
+        :param user_profile:    User Profile to query
+        :type user_profile:     UserProfile
+        :param today:           Date to query for.  For contract validity.
+        :type today:            datetime.date
+        :return:                Role tuples keyed by property id.  Properties
+                                where the user has no role are left out.
+        :rtype:                 dict
+        """
+        owners = self.filter(owners=user_profile).values_list('pk', flat=True)
+        managers = ManagementContract.objects.filter(property__in=self.values('pk'),
+                                                     manager=user_profile,
+                                                     start_date__lte=today,
+                                                     end_date__gte=today) \
+            .values_list('property', flat=True)
+        tenants = LeaseContract.objects.filter(property__in=self.values('pk'),
+                                               tenant=user_profile,
+                                               start_date__lte=today,
+                                               end_date__gte=today) \
+            .values_list('property', flat=True)
+        return collect_roles(owners, managers, tenants)
+
+    def get_rent_statuses(self, today):
+        """ Get the rent status for every property in the queryset
+
+        Same Paid, Due, Late, NA and !! semantics as Property.get_rent_status,
+        but computed with a constant number of queries no matter how many
+        properties are involved.
+
+        :param today:       The date to use for the calculation
+        :type today:        datetime.date
+        :return:            Rent status strings keyed by property id
+        :rtype:             dict
+        """
+        statuses = dict((pk, "!!") for pk in self.values_list('pk', flat=True))
+        if not statuses:
+            return statuses
+
+        leases = list(LeaseContract.objects.filter(property__in=list(statuses),
+                                                   start_date__lte=today,
+                                                   end_date__gte=today))
+        if not leases:
+            return statuses
+
+        due_dates = dict((lease.pk, last_rent_due_date(today, lease.rent_due_day))
+                         for lease in leases)
+        rent_type = InvoiceType.objects.get(name="Rent")
+        invoices = {}
+        for invoice in Invoice.objects.filter(type=rent_type,
+                                              payer__in=set(lease.tenant_id for lease in leases),
+                                              due_date__in=set(due_dates.values())):
+            invoices.setdefault((invoice.payer_id, invoice.due_date), invoice)
+
+        missing = set()
+        for lease in leases:
+            if lease.property_id in missing:
+                continue
+            invoice = invoices.get((lease.tenant_id, due_dates[lease.pk]))
+            if invoice is None:
+                logging.debug("No invoice found for lease %s" % lease.pk)
+                statuses[lease.property_id] = "!!"
+                missing.add(lease.property_id)
+            else:
+                statuses[lease.property_id] = rent_status(lease, today, invoice)
+
+        return statuses
+
 
 class Property(Addressable):
     """ A Property """
     class Meta:
         verbose_name_plural = "properties"
+
+    objects = PropertyQuerySet.as_manager()
+
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    geohash = models.CharField(max_length=GEOHASH_PRECISION, null=True, blank=True,
+                               db_index=True)
+
     owners = models.ManyToManyField('user_profiles.UserProfile', blank=True)
     manager = models.ManyToManyField('user_profiles.UserProfile', through=ManagementContract,
                                      through_fields=('property', 'manager'),
@@ -41,10 +323,10 @@ class Property(Addressable):
         :return:        list of active UserProfiles
         :rtype:         list of UserProfiles
         """
-        return [lease.tenant for lease in self.leasecontract_set.all()
-                if lease.start_date <= today and lease.end_date >= today]
+        return [lease.tenant for lease in
+                self.get_active_leases(today).select_related('tenant')]
 
-    def get_user_roles(self, user_profile, today):
+    def get_user_roles(self, user_profile, today, memo=None):
         """ Get the user roles for the property
 
         Can be 'tenant', 'manager', 'owner'.
@@ -53,29 +335,61 @@ class Property(Addressable):
         :type user_profile:     UserProfile
         :param today:           Date to query for.  For contract validity.
         :type today:            datetime.date
+        :param memo:            Optional cache of earlier answers, such as the
+                                one returned by role_memo for a request
+        :type memo:             dict
         :return:                A tuple of roles, or an empty list if none apply
         :rtype:                 tuple
         """
+        key = (self.pk, user_profile.pk, today)
+        if memo is not None and key in memo:
+            return memo[key]
+
         ret = []
 
         # Is the user an owner?
-        if user_profile in self.owners.all():
+        if self.owners.filter(pk=user_profile.pk).exists():
             ret.append('owner')
 
         # Is the user a manager?
-        if len(self.managementcontract_set.filter(manager=user_profile,
-                                                  start_date__lte=today,
-                                                  end_date__gte=today)) > 0:
+        if self.managementcontract_set.filter(manager=user_profile,
+                                              start_date__lte=today,
+                                              end_date__gte=today).exists():
             ret.append('manager')
 
         # Is the user a tenant?
-        if len(self.leasecontract_set.filter(tenant=user_profile,
-                                             start_date__lte=today,
-                                             end_date__gte=today)) > 0:
+        if self.leasecontract_set.filter(tenant=user_profile,
+                                         start_date__lte=today,
+                                         end_date__gte=today).exists():
             ret.append('tenant')
 
+        if memo is not None:
+            memo[key] = tuple(ret)
         return tuple(ret)
 
+    def get_users_roles(self, user_profiles, today):
+        """ Get the roles of several users on the property in three queries
+
+        :param user_profiles:   User Profiles to query
+        :type user_profiles:    iterable of UserProfile
+        :param today:           Date to query for.  For contract validity.
+        :type today:            datetime.date
+        :return:                Role tuples keyed by user profile id.  Users
+                                without a role are left out.
+        :rtype:                 dict
+        """
+        ids = [user_profile.pk for user_profile in user_profiles]
+        owners = self.owners.filter(pk__in=ids).values_list('pk', flat=True)
+        managers = self.managementcontract_set.filter(manager__in=ids,
+                                                      start_date__lte=today,
+                                                      end_date__gte=today) \
+            .values_list('manager', flat=True)
+        tenants = self.leasecontract_set.filter(tenant__in=ids,
+                                                start_date__lte=today,
+                                                end_date__gte=today) \
+            .values_list('tenant', flat=True)
+        return collect_roles(owners, managers, tenants)
+
     def get_active_leases(self, today):
         """ Get leases that are currently in effect for this property
 
@@ -103,32 +417,13 @@ class Property(Addressable):
         """
         ret = "!!"
         try:
-            leases = self.get_active_leases(today=date.today())
+            leases = self.get_active_leases(today=today)
             for lease in leases:
                 if today < lease.start_date:
                     logging.debug("Lease not started")
                     return "NA"
 
-                grace_period = lease.days_grace_period
-
-                try:
-                    this_month_due_date = date(year=today.year, month=today.month,
-                                               day=lease.rent_due_day)
-                except ValueError:
-                    # Failover to the last day of the month if day is unavailable
-                    this_month_due_date = date(year=today.year, month=today.month,
-                                               day=calendar.monthrange(today.year,
-                                                                       today.month)[1])
-                logging.debug("This month's due date: %s" % this_month_due_date)
-                grace_period = timedelta(days=grace_period)
-
-                ret = "Late"
-                if today < this_month_due_date:
-                    last_due = this_month_due_date-relativedelta(months=1)
-                    if last_due.day != lease.rent_due_day:
-                        last_due += relativedelta(day=lease.rent_due_day)
-                else:  # today >= this_month_due_date
-                    last_due = this_month_due_date
+                last_due = last_rent_due_date(today, lease.rent_due_day)
                 logging.debug("Rent was last due on %s. Today: %s" % (last_due, today))
 
                 # Check if an invoice exists for the date.
@@ -138,14 +433,8 @@ class Property(Addressable):
                                               payer=lease.tenant, )
                 logging.debug("Found invoice issued %s due %s" % (invoice.issued_date,
                                                                   invoice.due_date))
-                if invoice.paid_date:
-                    ret = "Paid"
-                    logging.debug("Rent was paid on %s" % invoice.paid_date)
-                else:
-                    if last_due <= today <= last_due+grace_period:
-                        ret = "Due"
-                        logging.debug("In grace period [%s, %s]" % (last_due,
-                                                                    last_due+grace_period))
+                ret = rent_status(lease, today, invoice)
+                logging.debug("Rent status for lease %s: %s" % (lease.pk, ret))
         except Invoice.DoesNotExist:
             logging.debug("No invoice found")
             ret = "!!"
@@ -174,11 +463,32 @@ class Property(Addressable):
         :param type:        The type of event this is.
         :type type:         str
         :return:            The populated entry
-        :rtype:             dict
+        :rtype:             ActivityEvent
         """
-        return tuple({'headline': headline, 'date': date, 'person': person,
-                'actionText': actionText, 'action': action,
-                'type': type}.iteritems())
+        return ActivityEvent(headline, date, person, actionText, action, type)
+
+    def get_tenant_messages(self, user):
+        """ Get the user's messages with the current tenants of this property
+
+        :param user:        The user whose messages to search
+        :type user:         UserProfile
+        :return:            Query set of messages, or None without tenants
+        :rtype:             django.models.QuerySet
+        """
+        tenants = self.get_tenants(date.today())
+        if len(tenants) == 0:
+            return None
+
+        values = [user.user.email, user.phone1, user.phone2]
+        values.extend(tenant.user.email for tenant in tenants)
+        values.extend(tenant.phone1 for tenant in tenants)
+        values.extend(tenant.phone2 for tenant in tenants)
+        addresses = set()
+        for value in values:
+            addresses.update(split_addresses(value))
+
+        return Message.objects.filter(property=self, user_profile=user,
+                                      addresses__address__in=addresses).distinct()
 
     def get_activity(self, user, today):
         """ Get activity for a property from a history of events.
@@ -337,18 +647,8 @@ class Property(Addressable):
 
         # Any messages between you and the tenant?  If you are the tenant, show
         # communication with others.
-        tenants = self.get_tenants(date.today())
-        if len(tenants) > 0:
-            values = [user.user.email, user.phone1, user.phone2]
-            values.extend(tenant.user.email for tenant in tenants)
-            values.extend(tenant.phone1 for tenant in tenants)
-            values.extend(tenant.phone2 for tenant in tenants if not tenant.phone2 is None)
-
-            fields = Q()
-            for x in values:
-                fields |= Q(sender=x) | Q(recipients=x)
-
-            messages = Message.objects.filter(fields, fields, property=self, user_profile=user)
+        messages = self.get_tenant_messages(user)
+        if messages is not None:
             for message in messages:
                 event = self.build_event("%s: %s" % (message.type.name, message.headline),
                                          message.creation_date, user, 'View',
@@ -388,13 +688,233 @@ class Property(Addressable):
                                                       args=(invoice.id,)),
                                          'invoice')
                 activity.append(event)
-        activity = [dict(x) for x in set(activity)]
-        activity.sort(key=lambda event: event['date'].date() if type(event['date']) == datetime else event['date'], reverse=True)
-        return activity
+        return [event.as_dict() for event in
+                sorted(set(activity), key=attrgetter('sort_key'), reverse=True)]
+
+    def get_cached_activity(self, user, today):
+        """ Get activity for a property through the activity cache
+
+        Same result as get_activity.  Feeds are cached per user, property and
+        day, and dropped as soon as one of their source rows changes.
+
+        :param user:        The user to generate events for
+        :type user:         UserProfile
+        :param today:       The date the activities are being viewed
+        :type today:        datetime.date
+        :return:            List of event dicts
+        :rtype:             list of dict
+        """
+        return activity_cache.get_activity(self, user, today)
+
+    def get_stored_activity(self, user, today):
+        """ Get activity for a property from the materialized event store
+
+        Same event dicts as get_activity, read with one indexed query from
+        PropertyActivity instead of being rebuilt from every source table.
+
+        :param user:        The user to generate events for
+        :type user:         UserProfile
+        :param today:       The date the activities are being viewed
+        :type today:        datetime.date
+        :return:            List of event dicts, newest first
+        :rtype:             list of dict
+        """
+        entries = PropertyActivity.objects.filter(Q(visible_from__isnull=True) |
+                                                  Q(visible_from__lte=today),
+                                                  user=user, property=self)
+        return [entry.as_event() for entry in
+                entries.select_related('person').order_by('-date', '-pk')]
+
+    def get_activity_sources(self, user, today):
+        """ Get the ordered event sources behind the activity feed
+
+        Each source is a (queryset, date field, event builder) triple.  Events
+        of a source are dated by its date field, so ordering the queryset by
+        that field orders its events.
+
+        :param user:        The user to generate events for
+        :type user:         UserProfile
+        :param today:       The date the activities are being viewed
+        :type today:        datetime.date
+        :return:            List of event sources
+        :rtype:             list of tuple
+        """
+        lease_filter = Q(tenant=user, property=self) | Q(property__manager=user)
+        if self.owners.filter(pk=user.pk).exists():
+            lease_filter |= Q(property=self)
+        leases = LeaseContract.objects.filter(lease_filter).distinct() \
+            .select_related('tenant')
+        mgmt_contracts = ManagementContract.objects.filter(manager=user,
+                                                           property=self) \
+            .select_related('owner')
+        requests = MaintenanceRequest.objects.filter(Q(assignee=user) | Q(created_by=user),
+                                                     property=self) \
+            .select_related('created_by', 'assignee')
+        invoices = Invoice.objects.filter(Q(payer=user) | Q(payee=user),
+                                          property=self) \
+            .select_related('type', 'payer', 'payee')
+
+        def lease_event(headline, day):
+            return lambda lease: self.build_event(headline, getattr(lease, day),
+                                                  lease.tenant, 'View Lease',
+                                                  angular_sref("lease-detail",
+                                                               args=(lease.id,)),
+                                                  'lease')
+
+        def mgmt_event(headline, day):
+            return lambda contract: self.build_event(headline, getattr(contract, day),
+                                                     contract.owner, 'View Contract',
+                                                     angular_sref("mgmt-contract-detail",
+                                                                  args=(contract.id,)),
+                                                     'management')
+
+        def request_event(headline, day, person):
+            return lambda request: self.build_event(headline % request.headline,
+                                                    getattr(request, day),
+                                                    getattr(request, person),
+                                                    'View Request',
+                                                    angular_sref("maintenance-detail",
+                                                                 args=(request.id,)),
+                                                    'maintenance')
+
+        def message_event(message):
+            return self.build_event("%s: %s" % (message.type.name, message.headline),
+                                    message.creation_date, user, 'View',
+                                    angular_sref("message-detail", args=(message.id,)),
+                                    message.type.name)
+
+        def invoice_event(headline, day):
+            return lambda invoice: self.build_event(headline % (invoice.type.name,
+                                                                str(invoice.amount())),
+                                                    getattr(invoice, day),
+                                                    invoice.payer if invoice.payer != user
+                                                    else invoice.payee,
+                                                    'View Invoice',
+                                                    angular_sref("invoice-detail",
+                                                                 args=(invoice.id,)),
+                                                    'invoice')
+
+        sources = [
+            (leases, 'start_date', lease_event("Lease Started", 'start_date')),
+            (leases.filter(end_date__lte=today), 'end_date',
+             lease_event("Lease Ended", 'end_date')),
+            (mgmt_contracts, 'start_date', mgmt_event('Management Started', 'start_date')),
+            (mgmt_contracts.filter(end_date__lte=today), 'end_date',
+             mgmt_event('Management Ended', 'end_date')),
+            (requests, 'creation_date',
+             request_event("New Request: %s", 'creation_date', 'created_by')),
+            (requests.filter(resolution_date__lte=today), 'resolution_date',
+             request_event("Closed Request: %s", 'resolution_date', 'assignee')),
+            (requests.filter(assigned_date__lte=today), 'assigned_date',
+             request_event("Assigned Request: %s", 'assigned_date', 'assignee')),
+            (invoices, 'issued_date', invoice_event("%s Created: %s", 'issued_date')),
+            (invoices.filter(due_date__lte=today), 'due_date',
+             invoice_event("%s Due: %s", 'due_date')),
+            (invoices.filter(paid_date__lte=today), 'paid_date',
+             invoice_event("%s Paid: %s", 'paid_date')),
+        ]
+        messages = self.get_tenant_messages(user)
+        if messages is not None:
+            sources.append((messages.select_related('type'), 'creation_date',
+                            message_event))
+        return sources
+
+    def get_activity_page(self, user, today, limit=20, cursor=None):
+        """ Get one page of the activity feed, newest first
+
+        Each event source is read as a stream already ordered by date, and the
+        streams are lazily merged, so the cost of a page depends on ``limit``
+        rather than on the length of the property's history.  Events sharing
+        a date are ordered by source, then by time and row id.
+
+        :param user:        The user to generate events for
+        :type user:         UserProfile
+        :param today:       The date the activities are being viewed
+        :type today:        datetime.date
+        :param limit:       Number of events per page
+        :type limit:        int
+        :param cursor:      Cursor returned with the previous page, if any
+        :type cursor:       str
+        :return:            The page of event dicts and the cursor of the next
+                            page, which is None on the last page
+        :rtype:             tuple
+        :raises ValueError: If the cursor is malformed
+        """
+        after = decode_cursor(cursor, 4) if cursor else None
+        streams = [self._activity_stream(index, queryset, field, build, limit, after)
+                   for index, (queryset, field, build)
+                   in enumerate(self.get_activity_sources(user, today))]
+
+        page = list(islice(heapq.merge(*streams), limit + 1))
+        next_cursor = encode_cursor(page[limit - 1][0]) if len(page) > limit else None
+        return [event.as_dict() for _, event in page[:limit]], next_cursor
+
+    @staticmethod
+    def _activity_stream(index, queryset, field, build, limit, after):
+        """ Read one event source as a stream of (sort key, event) pairs
+
+        Sort keys are (negated day ordinal, source index, negated timestamp,
+        negated row id), so ascending keys are newest first.  The timestamp is
+        in microseconds for datetime fields and 0 for date fields, which keeps
+        each stream in the order of its own query.  Rows at or before the
+        ``after`` key are excluded in the query itself.
+
+        :return:    Stream ordered by sort key
+        :rtype:     generator of tuple
+        """
+        timed = isinstance(queryset.model._meta.get_field(field), models.DateTimeField)
+        if after is not None:
+            day = date.fromordinal(-after[0])
+            if index < after[1]:
+                queryset = queryset.filter(**{field + '__lt': day})
+            elif index > after[1]:
+                queryset = queryset.filter(**{field + '__lt': day + timedelta(days=1)})
+            else:
+                last = micros_to_datetime(-after[2]) if timed else day
+                queryset = queryset.filter(Q(**{field + '__lt': last}) |
+                                           Q(**{field: last, 'pk__lt': -after[3]}))
+        for obj in queryset.order_by('-' + field, '-pk')[:limit + 1]:
+            day = getattr(obj, field)
+            if timed:
+                micros = datetime_to_micros(day)
+                day = (timezone.localtime(day) if timezone.is_aware(day) else day).date()
+            else:
+                micros = 0
+            yield (-day.toordinal(), index, -micros, -obj.pk), build(obj)
+
+    def get_occupants(self, today):
+        """ Get the ids of the tenants occupying the property on a date
+
+        Answered from the in-memory occupancy index, without a query.
+
+        :param today:       The date to check
+        :type today:        datetime.date
+        :return:            Tenant UserProfile ids
+        :rtype:             list of int
+        """
+        return occupancy_index.occupants(self.pk, today)
+
+    def locate(self, geocoder=None):
+        """ Fill in the coordinates and geohash from the address
+
+        Keeps the current coordinates when the geocoder finds nothing.
+
+        :param geocoder:    Geocoder to use, get_geocoder() by default
+        :type geocoder:     geo.Geocoder
+        """
+        location = (geocoder or get_geocoder()).geocode(self)
+        if location is not None:
+            self.latitude, self.longitude = location
+        self.geohash = geohash_encode(self.latitude, self.longitude) \
+            if self.latitude is not None and self.longitude is not None else None
 
 
 class PropertyProfile(models.Model):
     """ A description of a property """
+    class Meta:
+        index_together = (('type', 'bedrooms', 'baths'),
+                          ('bedrooms', 'sqft'))
+
     type = models.CharField(choices=(('th', "Townhome"), ('ap', "Apartment"),
                                      ('sf', "Single Family"), ('co', "Condo")),
                             max_length=2)
@@ -421,9 +941,86 @@ class PropertyImage(models.Model):
     def __unicode__(self):
         return "Image for %s" % self.property_profile.property.address1
 
+    def variant_url(self, variant):
+        """ Get the stable URL of a cached variant of the image
+
+        :param variant:     Name of a variant in image_variants.VARIANTS, such
+                            as 'thumb'
+        :type variant:      str
+        :return:            The variant's URL
+        :rtype:             str
+        """
+        return reverse("property-image-variant", kwargs={'pk': self.pk,
+                                                         'variant': variant})
+
+
+class PropertyListingQuerySet(models.QuerySet):
+    """ Searches over property listings """
+
+    def search(self, rent_min=None, rent_max=None, pets=None, furnished=None,
+               types=None, bedrooms_min=None, baths_min=None, sqft_min=None,
+               sqft_max=None, parking=None):
+        """ Find active listings matching every given criterion
+
+        Results are ordered by rent and id, the order the listing indexes
+        serve and keyset pagination relies on.
+
+        :param rent_min:        Lowest monthly rent
+        :type rent_min:         decimal.Decimal
+        :param rent_max:        Highest monthly rent
+        :type rent_max:         decimal.Decimal
+        :param pets:            Number of pets that must be allowed
+        :type pets:             int
+        :param furnished:       Furnished or not
+        :type furnished:        bool
+        :param types:           Property type codes, e.g. ('ap', 'co')
+        :type types:            iterable of str
+        :param bedrooms_min:    Fewest bedrooms
+        :type bedrooms_min:     int
+        :param baths_min:       Fewest baths
+        :type baths_min:        decimal.Decimal
+        :param sqft_min:        Smallest floor area
+        :type sqft_min:         int
+        :param sqft_max:        Largest floor area
+        :type sqft_max:         int
+        :param parking:         Parking codes, e.g. ('ga', 'co')
+        :type parking:          iterable of str
+        :return:                Query set of listings
+        :rtype:                 django.models.QuerySet
+        """
+        qs = self.filter(active=True)
+        if rent_min is not None:
+            qs = qs.filter(rent__gte=rent_min)
+        if rent_max is not None:
+            qs = qs.filter(rent__lte=rent_max)
+        if pets:
+            qs = qs.filter(allow_pets=True, max_pets__gte=pets)
+        if furnished is not None:
+            qs = qs.filter(furnished=furnished)
+        if types:
+            qs = qs.filter(property__profile__type__in=types)
+        if bedrooms_min is not None:
+            qs = qs.filter(property__profile__bedrooms__gte=bedrooms_min)
+        if baths_min is not None:
+            qs = qs.filter(property__profile__baths__gte=baths_min)
+        if sqft_min is not None:
+            qs = qs.filter(property__profile__sqft__gte=sqft_min)
+        if sqft_max is not None:
+            qs = qs.filter(property__profile__sqft__lte=sqft_max)
+        if parking:
+            qs = qs.filter(property__profile__parking__in=parking)
+        return qs.order_by('rent', 'pk')
+
 
 class PropertyListing(models.Model):
     """ For publishing an availability """
+    class Meta:
+        index_together = (('active', 'rent'),
+                          ('active', 'allow_pets', 'max_pets', 'rent'),
+                          ('active', 'furnished', 'rent'))
+
+    objects = PropertyListingQuerySet.as_manager()
+
     property = models.OneToOneField(Property)
     rent = models.DecimalField(decimal_places=2, max_digits=10, default=0.)
     allow_pets = models.BooleanField(default=True)
@@ -485,3 +1082,605 @@ class AccessControl(models.Model):
         return "%s %s" % (self.property.get_full_street_address(), self.get_type_display())
 
 
+
+
+class RentScheduleQuerySet(models.QuerySet):
+    """ Maintenance and lookups for the materialized rent schedule """
+
+    def schedule_lease(self, lease, through):
+        """ Bring the schedule of a lease in line with its current terms
+
+        Rows that no longer match a due date of the lease are removed, kept
+        ones get the lease's current grace period and missing ones are
+        created, so it is safe to call on every save.
+
+        :param lease:       The lease to schedule
+        :type lease:        LeaseContract
+        :param through:     Last date to schedule up to
+        :type through:      datetime.date
+        """
+        due_dates = set(rent_due_dates(lease, through))
+        self.filter(lease=lease).exclude(due_date__in=due_dates).delete()
+        grace_end = F('due_date') + timedelta(days=lease.days_grace_period)
+        self.filter(lease=lease).exclude(grace_end=grace_end).update(grace_end=grace_end)
+        due_dates -= set(self.filter(lease=lease).values_list('due_date', flat=True))
+        self.bulk_create(RentSchedule.for_lease(lease, due_date)
+                         for due_date in sorted(due_dates))
+
+    def extend(self, through, batch_size=1000):
+        """ Extend the schedule of every running lease up to a date
+
+        Only the billing periods after the last scheduled one are created, so
+        running this regularly is cheap.  Leases that ended more than a month
+        before ``through`` are skipped; they were scheduled when last saved
+        and by earlier runs.
+
+        :param through:     Last date to schedule up to
+        :type through:      datetime.date
+        :param batch_size:  Rows per insert
+        :type batch_size:   int
+        :return:            Number of rows created
+        :rtype:             int
+        """
+        scheduled = dict(self.values_list('lease').annotate(Max('due_date')))
+        leases = LeaseContract.objects.filter(start_date__lte=through,
+                                              end_date__gte=through-relativedelta(months=1))
+        rows = []
+        for lease in leases.iterator():
+            last = scheduled.get(lease.pk)
+            rows.extend(RentSchedule.for_lease(lease, due_date)
+                        for due_date in rent_due_dates(lease, through)
+                        if last is None or due_date > last)
+        self.bulk_create(rows, batch_size=batch_size)
+        return len(rows)
+
+    def link_invoices(self, batch_size=500):
+        """ Attach rent invoices to the scheduled periods that lack one
+
+        :param batch_size:  Rows per update
+        :type batch_size:   int
+        :return:            Number of rows linked
+        :rtype:             int
+        """
+        unlinked = list(self.filter(invoice__isnull=True)
+                        .values_list('pk', 'lease__tenant', 'due_date'))
+        if not unlinked:
+            return 0
+
+        rent_type = InvoiceType.objects.get(name="Rent")
+        invoices = {}
+        for invoice_id, payer_id, due_date in \
+                Invoice.objects.filter(type=rent_type,
+                                       payer__in=set(row[1] for row in unlinked),
+                                       due_date__in=set(row[2] for row in unlinked)) \
+                .order_by('pk').values_list('pk', 'payer', 'due_date'):
+            invoices.setdefault((payer_id, due_date), invoice_id)
+
+        links = [(pk, invoices[(tenant_id, due_date)])
+                 for pk, tenant_id, due_date in unlinked
+                 if (tenant_id, due_date) in invoices]
+        for start in range(0, len(links), batch_size):
+            batch = links[start:start+batch_size]
+            RentSchedule.objects.filter(pk__in=[pk for pk, _ in batch]).update(
+                invoice=Case(*[When(pk=pk, then=Value(invoice_id))
+                               for pk, invoice_id in batch],
+                             output_field=models.IntegerField()))
+        return len(links)
+
+    def get_rent_status(self, property, today):
+        """ Get the rent status of a property from the schedule
+
+        Same semantics as Property.get_rent_status, answered from the last
+        scheduled period of each active lease.
+
+        :param property:    The property to check
+        :type property:     Property
+        :param today:       The date to use for the calculation
+        :type today:        datetime.date
+        :return:            Rent status string
+        :rtype:             str
+        """
+        rows = self.filter(property=property,
+                           lease__start_date__lte=today,
+                           lease__end_date__gte=today,
+                           due_date__lte=today,
+                           due_date__gt=today-timedelta(days=32))
+        ret = "!!"
+        seen = set()
+        for row in rows.select_related('invoice').order_by('lease', '-due_date'):
+            if row.lease_id in seen:
+                continue
+            seen.add(row.lease_id)
+            ret = row.get_status(today)
+            if ret == "!!":
+                break
+        return ret
+
+
+class RentSchedule(models.Model):
+    """ One billing period of a lease, with its due date and rent invoice """
+    class Meta:
+        unique_together = (('lease', 'due_date'),)
+        index_together = (('property', 'due_date'),)
+
+    objects = RentScheduleQuerySet.as_manager()
+
+    lease = models.ForeignKey(LeaseContract)
+    property = models.ForeignKey(Property)
+    due_date = models.DateField()
+    grace_end = models.DateField()
+    invoice = models.ForeignKey(Invoice, null=True, blank=True,
+                                on_delete=models.SET_NULL)
+
+    def __unicode__(self):
+        return "Rent due %s for lease %s" % (self.due_date, self.lease_id)
+
+    @classmethod
+    def for_lease(cls, lease, due_date):
+        """ Build an unsaved schedule row for a lease's due date
+
+        :param lease:       The lease being scheduled
+        :type lease:        LeaseContract
+        :param due_date:    The clamped due date of the period
+        :type due_date:     datetime.date
+        :return:            The unsaved row
+        :rtype:             RentSchedule
+        """
+        return cls(lease=lease, property_id=lease.property_id,
+                   due_date=due_date,
+                   grace_end=due_date+timedelta(days=lease.days_grace_period))
+
+    def get_status(self, today):
+        """ Get the rent status of this period
+
+        :param today:       The date to use for the calculation
+        :type today:        datetime.date
+        :return:            Rent status string
+        :rtype:             str
+        """
+        if self.invoice is None:
+            return "!!"
+        if self.invoice.paid_date:
+            return "Paid"
+        if self.due_date <= today <= self.grace_end:
+            return "Due"
+        return "Late"
+
+
+@receiver(post_save, sender=LeaseContract)
+def schedule_lease_rent(sender, instance, **kwargs):
+    """ Keep the rent schedule in line with lease changes """
+    RentSchedule.objects.schedule_lease(instance, through=date.today())
+
+
+@receiver(post_save, sender=Invoice)
+def link_rent_invoice(sender, instance, **kwargs):
+    """ Attach a saved rent invoice to its scheduled period """
+    if instance.due_date is None or instance.type.name != "Rent":
+        return
+    RentSchedule.objects.filter(invoice__isnull=True,
+                                lease__tenant=instance.payer_id,
+                                due_date=instance.due_date).update(invoice=instance.pk)
+
+
+@receiver(post_save, sender=LeaseContract)
+@receiver(post_delete, sender=LeaseContract)
+def invalidate_occupancy(sender, **kwargs):
+    """ Reload the occupancy index after lease changes """
+    occupancy_index.invalidate()
+
+
+#: Shared cache key of the listing_search index version
+LISTING_INDEX_VERSION = "listing-index-version"
+
+
+@receiver(post_save, sender=PropertyListing)
+@receiver(post_delete, sender=PropertyListing)
+@receiver(post_save, sender=PropertyProfile)
+@receiver(post_delete, sender=PropertyProfile)
+def invalidate_listing_index(sender, **kwargs):
+    """ Reload the listing index after listing changes, in every process """
+    bump_version(caches['default'], LISTING_INDEX_VERSION)
+
+
+class PropertyActivityQuerySet(models.QuerySet):
+    """ Maintenance of the materialized activity events """
+
+    def refresh(self, source):
+        """ Replace the stored events of a source row
+
+        :param source:  A lease, management contract, maintenance request,
+                        message or invoice
+        :type source:   django.db.models.Model
+        """
+        self.filter(source_type=source._meta.model_name,
+                    source_id=source.pk).delete()
+        self.bulk_create(activity_entries(source))
+
+    def rebuild(self, model, batch_size=1000):
+        """ Rebuild the stored events of every row of a source model
+
+        :param model:       One of the models in ACTIVITY_SOURCES
+        :type model:        django.db.models.Model
+        :param batch_size:  Rows per insert
+        :type batch_size:   int
+        :return:            Number of events stored
+        :rtype:             int
+        """
+        self.filter(source_type=model._meta.model_name).delete()
+        stored = 0
+        entries = []
+        for source in model.objects.all().iterator():
+            entries.extend(activity_entries(source))
+            if len(entries) >= batch_size:
+                self.bulk_create(entries)
+                stored += len(entries)
+                entries = []
+        self.bulk_create(entries)
+        return stored + len(entries)
+
+
+class PropertyActivity(models.Model):
+    """ One event of a user's activity feed for a property
+
+    Maintained from the source rows by signals, see ACTIVITY_SOURCES.
+    """
+    class Meta:
+        verbose_name_plural = "property activities"
+        index_together = (('user', 'property', 'date'),
+                          ('source_type', 'source_id'))
+
+    objects = PropertyActivityQuerySet.as_manager()
+
+    user = models.ForeignKey('user_profiles.UserProfile', related_name='+')
+    property = models.ForeignKey(Property)
+    date = models.DateField()
+    # Events such as "Lease Ended" only show once this date has passed
+    visible_from = models.DateField(null=True, blank=True)
+    headline = models.CharField(max_length=512)
+    person = models.ForeignKey('user_profiles.UserProfile', null=True, blank=True,
+                               related_name='+')
+    action_text = models.CharField(max_length=64)
+    action = models.CharField(max_length=255)
+    type = models.CharField(max_length=32)
+    source_type = models.CharField(max_length=32)
+    source_id = models.IntegerField()
+
+    def __unicode__(self):
+        return "%s: %s" % (self.date, self.headline)
+
+    def as_event(self):
+        """ Get the event in the format returned by Property.get_activity
+
+        :return:    The event dict
+        :rtype:     dict
+        """
+        return {'headline': self.headline, 'date': self.date, 'person': self.person,
+                'actionText': self.action_text, 'action': self.action,
+                'type': self.type}
+
+
+def _activity_entry(source, users, headline, day, person, action_text, action,
+                    type, conditional=False):
+    """ Build the stored copies of one event, one per user who sees it
+
+    :param conditional: Only show the event once its date has passed
+    :type conditional:  bool
+    :return:            Unsaved events
+    :rtype:             list of PropertyActivity
+    """
+    if source.property_id is None:
+        return []
+    if isinstance(day, datetime):
+        day = day.date()
+    return [PropertyActivity(user_id=user_id, property_id=source.property_id,
+                             date=day, visible_from=day if conditional else None,
+                             headline=headline, person=person,
+                             action_text=action_text, action=action, type=type,
+                             source_type=source._meta.model_name,
+                             source_id=source.pk)
+            for user_id in set(users) if user_id is not None]
+
+
+def _lease_activity(lease):
+    users = [lease.tenant_id]
+    users.extend(lease.property.owners.values_list('pk', flat=True))
+    users.extend(lease.property.manager.values_list('pk', flat=True))
+    action = angular_sref("lease-detail", args=(lease.id,))
+    entries = _activity_entry(lease, users, "Lease Started", lease.start_date,
+                              lease.tenant, 'View Lease', action, 'lease')
+    entries.extend(_activity_entry(lease, users, "Lease Ended", lease.end_date,
+                                   lease.tenant, 'View Lease', action, 'lease',
+                                   conditional=True))
+    return entries
+
+
+def _management_activity(contract):
+    users = [contract.manager_id]
+    action = angular_sref("mgmt-contract-detail", args=(contract.id,))
+    entries = _activity_entry(contract, users, 'Management Started',
+                              contract.start_date, contract.owner,
+                              'View Contract', action, 'management')
+    entries.extend(_activity_entry(contract, users, 'Management Ended',
+                                   contract.end_date, contract.owner,
+                                   'View Contract', action, 'management',
+                                   conditional=True))
+    return entries
+
+
+def _maintenance_activity(request):
+    users = [request.assignee_id, request.created_by_id]
+    action = angular_sref("maintenance-detail", args=(request.id,))
+    entries = _activity_entry(request, users, "New Request: %s" % request.headline,
+                              request.creation_date, request.created_by,
+                              'View Request', action, 'maintenance')
+    if request.resolution_date:
+        entries.extend(_activity_entry(request, users,
+                                       "Closed Request: %s" % request.headline,
+                                       request.resolution_date, request.assignee,
+                                       'View Request', action, 'maintenance',
+                                       conditional=True))
+    if request.assigned_date:
+        entries.extend(_activity_entry(request, users,
+                                       "Assigned Request: %s" % request.headline,
+                                       request.assigned_date, request.assignee,
+                                       'View Request', action, 'maintenance',
+                                       conditional=True))
+    return entries
+
+
+def _message_activity(message):
+    if message.property_id is None:
+        return []
+    return _activity_entry(message, [message.user_profile_id],
+                           "%s: %s" % (message.type.name, message.headline),
+                           message.creation_date, message.user_profile, 'View',
+                           angular_sref("message-detail", args=(message.id,)),
+                           message.type.name)
+
+
+def _invoice_activity(invoice):
+    action = angular_sref("invoice-detail", args=(invoice.id,))
+    amount = str(invoice.amount())
+    entries = []
+    # Each party sees the other one as the person involved
+    for user, person in ((invoice.payer, invoice.payee), (invoice.payee, invoice.payer)):
+        if user is None:
+            continue
+        entries.extend(_activity_entry(invoice, [user.pk],
+                                       "%s Created: %s" % (invoice.type.name, amount),
+                                       invoice.issued_date, person,
+                                       'View Invoice', action, 'invoice'))
+        if invoice.due_date:
+            entries.extend(_activity_entry(invoice, [user.pk],
+                                           "%s Due: %s" % (invoice.type.name, amount),
+                                           invoice.due_date, person,
+                                           'View Invoice', action, 'invoice',
+                                           conditional=True))
+        if invoice.paid_date:
+            entries.extend(_activity_entry(invoice, [user.pk],
+                                           "%s Paid: %s" % (invoice.type.name, amount),
+                                           invoice.paid_date, person,
+                                           'View Invoice', action, 'invoice',
+                                           conditional=True))
+    return entries
+
+
+#: Models whose rows produce activity events, and the event builder of each
+ACTIVITY_SOURCES = {
+    LeaseContract: _lease_activity,
+    ManagementContract: _management_activity,
+    MaintenanceRequest: _maintenance_activity,
+    Message: _message_activity,
+    Invoice: _invoice_activity,
+}
+
+
+def activity_entries(source):
+    """ Build the stored activity events of a source row
+
+    :param source:  A row of one of the models in ACTIVITY_SOURCES
+    :type source:   django.db.models.Model
+    :return:        Unsaved events
+    :rtype:         list of PropertyActivity
+    """
+    for model, build in ACTIVITY_SOURCES.items():
+        if isinstance(source, model):
+            return build(source)
+    raise TypeError("No activity events for %s" % type(source).__name__)
+
+
+activity_cache = ActivityCache(
+    lambda property, user, today: property.get_activity(user, today),
+    maxsize=getattr(settings, 'PROPERTY_ACTIVITY_CACHE_SIZE', 1024),
+    timeout=getattr(settings, 'PROPERTY_ACTIVITY_CACHE_TIMEOUT', 24 * 60 * 60))
+
+
+def invalidate_activity(source):
+    """ Drop the cached feeds a source row appears in
+
+    :param source:  A row of one of the models in ACTIVITY_SOURCES
+    :type source:   django.db.models.Model
+    """
+    if source.property_id is None:
+        return
+    property_ids = set([source.property_id])
+    # get_activity lists the leases of every property the user manages
+    if isinstance(source, LeaseContract):
+        managers = ManagementContract.objects.filter(property=source.property_id) \
+            .values('manager')
+        property_ids.update(ManagementContract.objects.filter(manager__in=managers)
+                            .values_list('property', flat=True))
+    elif isinstance(source, ManagementContract):
+        property_ids.update(ManagementContract.objects.filter(manager=source.manager_id)
+                            .values_list('property', flat=True))
+    for property_id in property_ids:
+        activity_cache.invalidate(property_id)
+
+
+def refresh_activity(sender, instance, **kwargs):
+    """ Store the activity events of a saved source row """
+    invalidate_activity(instance)
+    PropertyActivity.objects.refresh(instance)
+    if sender is ManagementContract:
+        # Managers see the leases of the properties they manage
+        for lease in LeaseContract.objects.filter(property=instance.property_id):
+            PropertyActivity.objects.refresh(lease)
+
+
+def delete_activity(sender, instance, **kwargs):
+    """ Drop the activity events of a deleted source row """
+    invalidate_activity(instance)
+    PropertyActivity.objects.filter(source_type=instance._meta.model_name,
+                                    source_id=instance.pk).delete()
+    if sender is ManagementContract:
+        # The former manager no longer sees the property's leases
+        for lease in LeaseContract.objects.filter(property=instance.property_id):
+            PropertyActivity.objects.refresh(lease)
+
+
+for _model in ACTIVITY_SOURCES:
+    post_save.connect(refresh_activity, sender=_model,
+                      dispatch_uid="property-activity-%s" % _model._meta.model_name)
+    post_delete.connect(delete_activity, sender=_model,
+                        dispatch_uid="property-activity-%s" % _model._meta.model_name)
+
+
+@receiver(m2m_changed, sender=Property.owners.through)
+def refresh_owner_activity(sender, instance, action, reverse, pk_set, **kwargs):
+    """ Owners see the leases of their properties
+
+    Changes made from either side are handled: ``property.owners`` sends the
+    property, ``user_profile.property_set`` the owner and the property ids.
+    """
+    if reverse and action == 'pre_clear':
+        # The owner's properties are no longer listed by post_clear
+        instance._cleared_property_ids = list(Property.objects.filter(owners=instance)
+                                              .values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        property_ids = [instance.pk]
+    elif action == 'post_clear':
+        property_ids = instance.__dict__.pop('_cleared_property_ids', [])
+    else:
+        property_ids = list(pk_set or ())
+    for property_id in property_ids:
+        activity_cache.invalidate(property_id)
+    for lease in LeaseContract.objects.filter(property__in=property_ids):
+        PropertyActivity.objects.refresh(lease)
+
+
+class MessageAddressQuerySet(models.QuerySet):
+    """ Maintenance of the message contact-address index """
+
+    def index(self, messages):
+        """ Index the senders and recipients of messages
+
+        :param messages:    Messages to (re)index
+        :type messages:     iterable of Message
+        :return:            Number of addresses stored
+        :rtype:             int
+        """
+        entries = []
+        message_ids = []
+        for message in messages:
+            message_ids.append(message.pk)
+            entries.extend(MessageAddress(message_id=message.pk, address=address,
+                                          role=MessageAddress.SENDER)
+                           for address in split_addresses(message.sender))
+            entries.extend(MessageAddress(message_id=message.pk, address=address,
+                                          role=MessageAddress.RECIPIENT)
+                           for address in split_addresses(message.recipients))
+        self.filter(message__in=message_ids).delete()
+        self.bulk_create(entries)
+        return len(entries)
+
+
+class MessageAddress(models.Model):
+    """ A normalized sender or recipient address of a message """
+    SENDER = 's'
+    RECIPIENT = 'r'
+
+    objects = MessageAddressQuerySet.as_manager()
+
+    message = models.ForeignKey(Message, related_name='addresses')
+    address = models.CharField(max_length=255, db_index=True)
+    role = models.CharField(choices=((SENDER, "Sender"), (RECIPIENT, "Recipient")),
+                            max_length=1)
+
+    def __unicode__(self):
+        return "%s (%s)" % (self.address, self.get_role_display())
+
+
+@receiver(post_save, sender=Message)
+def index_message_addresses(sender, instance, created, **kwargs):
+    """ Index the addresses of messages as they are ingested """
+    if created or 'sender' in (kwargs.get('update_fields') or ()) or \
+            'recipients' in (kwargs.get('update_fields') or ()):
+        MessageAddress.objects.index([instance])
+
+
+class GMailSyncCheckpoint(models.Model):
+    """ How far a user's GMail mailbox has been synced """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, primary_key=True)
+    history_id = models.CharField(max_length=32, null=True, blank=True)
+    last_synced = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return "GMail sync of %s at history %s" % (self.user, self.history_id)
+
+
+class TwitterSyncCheckpoint(models.Model):
+    """ How far a user's Twitter home timeline has been synced
+
+    Tweets up to ``since_id`` are stored.  While a newer stretch of the
+    timeline is being paged in, ``max_id`` is where paging resumes and
+    ``newest_id`` becomes the next ``since_id`` once the gap is closed.
+    """
+    auth = models.OneToOneField(TwitterAuth, primary_key=True)
+    since_id = models.BigIntegerField(null=True, blank=True)
+    max_id = models.BigIntegerField(null=True, blank=True)
+    newest_id = models.BigIntegerField(null=True, blank=True)
+    last_synced = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return "Twitter sync of %s since %s" % (self.auth.user, self.since_id)
+
+
+#: Property fields the geocoders read
+ADDRESS_FIELDS = ('address1', 'address2', 'city', 'state', 'zip')
+
+
+@receiver(pre_save, sender=Property)
+def locate_property(sender, instance, **kwargs):
+    """ Geocode new and moved properties and keep geohashes in line with
+    coordinates
+    """
+    if instance.pk is not None and instance.latitude is not None:
+        stored = Property.objects.filter(pk=instance.pk) \
+            .values_list('latitude', 'longitude', *ADDRESS_FIELDS).first()
+        # A new address without new coordinates needs geocoding again
+        if stored is not None and \
+                stored[:2] == (instance.latitude, instance.longitude) and \
+                stored[2:] != tuple(getattr(instance, field) for field in ADDRESS_FIELDS):
+            instance.latitude = instance.longitude = None
+    if instance.latitude is None or instance.longitude is None:
+        instance.locate()
+    else:
+        instance.geohash = geohash_encode(instance.latitude, instance.longitude)
+
+
+class MessageBodyBlob(models.Model):
+    """ A compressed message body, stored once per distinct content """
+    digest = models.CharField(max_length=40, primary_key=True)
+    data = models.BinaryField()
+    size = models.IntegerField()
+
+    def __unicode__(self):
+        return "Body %s (%d bytes)" % (self.digest, self.size)
+
+
+# Large message bodies are compressed when saved and resolved when read
+body_store.install(Message, 'body')
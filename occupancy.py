@@ -0,0 +1,145 @@
+"""
+Occupancy Index
+***************
+
+In-memory interval index of lease occupancy, answering who occupies a
+property and which properties are vacant on a date without scanning every
+lease.
+
+"""
+from bisect import bisect_right
+
+from django.conf import settings
+from contracts.models import LeaseContract
+
+from .caching import SharedIndex
+
+
+class IntervalTree(object):
+    """ Static centered interval tree over closed intervals
+
+    Stabbing queries take O(log n + k) for k matching intervals.
+    """
+    __slots__ = ('center', 'by_start', 'by_end', 'left', 'right')
+
+    def __init__(self, intervals):
+        """
+        :param intervals:   (start, end, value) triples with start <= end
+        :type intervals:    list of tuple
+        """
+        starts = sorted(interval[0] for interval in intervals)
+        self.center = starts[len(starts) // 2]
+        left, right, here = [], [], []
+        for interval in intervals:
+            if interval[1] < self.center:
+                left.append(interval)
+            elif interval[0] > self.center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        self.by_start = sorted(here, key=lambda interval: interval[0])
+        self.by_end = sorted(here, key=lambda interval: interval[1], reverse=True)
+        self.left = IntervalTree(left) if left else None
+        self.right = IntervalTree(right) if right else None
+
+    def stab(self, point):
+        """ Get the values of every interval containing a point
+
+        :param point:   The point to look up
+        :return:        Matching values
+        :rtype:         generator
+        """
+        node = self
+        while node is not None:
+            if point < node.center:
+                for start, _, value in node.by_start:
+                    if start > point:
+                        break
+                    yield value
+                node = node.left
+            elif point > node.center:
+                for _, end, value in node.by_end:
+                    if end < point:
+                        break
+                    yield value
+                node = node.right
+            else:
+                for _, _, value in node.by_start:
+                    yield value
+                node = None
+
+
+class OccupancyIndex(SharedIndex):
+    """ Lease occupancy of the whole portfolio
+
+    Loaded from the lease table on first use and reloaded lazily after
+    invalidate() is called in any process, which the lease signals in
+    models.py do.
+    """
+    version_key = "occupancy-index-version"
+
+    def __init__(self, **kwargs):
+        super(OccupancyIndex, self).__init__(**kwargs)
+        self._leases = {}
+        self._tree = None
+
+    def load(self):
+        leases = {}
+        intervals = []
+        for property_id, tenant_id, start_date, end_date in \
+                LeaseContract.objects.values_list('property', 'tenant', 'start_date',
+                                                  'end_date').iterator():
+            start, end = start_date.toordinal(), end_date.toordinal()
+            leases.setdefault(property_id, []).append((start, end, tenant_id))
+            intervals.append((start, end, property_id))
+        for property_leases in leases.values():
+            property_leases.sort()
+        self._leases = leases
+        self._tree = IntervalTree(intervals) if intervals else None
+
+    def occupants(self, property_id, day):
+        """ Get the tenants occupying a property on a date
+
+        :param property_id: The property
+        :type property_id:  int
+        :param day:         The date
+        :type day:          datetime.date
+        :return:            Tenant user profile ids
+        :rtype:             list of int
+        """
+        self.refresh()
+        point = day.toordinal()
+        leases = self._leases.get(property_id, ())
+        return [tenant_id for start, end, tenant_id
+                in leases[:bisect_right(leases, (point, float('inf')))]
+                if end >= point]
+
+    def occupied(self, day):
+        """ Get every property with a lease in effect on a date
+
+        :param day:         The date
+        :type day:          datetime.date
+        :return:            Property ids
+        :rtype:             set of int
+        """
+        self.refresh()
+        tree = self._tree
+        if tree is None:
+            return set()
+        return set(tree.stab(day.toordinal()))
+
+    def vacant(self, property_ids, day):
+        """ Get the properties without a lease in effect on a date
+
+        :param property_ids:    Properties to check
+        :type property_ids:     iterable of int
+        :param day:             The date
+        :type day:              datetime.date
+        :return:                Vacant property ids
+        :rtype:                 set of int
+        """
+        return set(property_ids) - self.occupied(day)
+
+
+#: Process-wide occupancy index
+occupancy_index = OccupancyIndex(max_age=getattr(settings, 'PROPERTY_INDEX_MAX_AGE', 300))
@@ -0,0 +1,75 @@
+"""
+Keyset Pagination
+*****************
+
+Opaque cursors for keyset-paginated feeds.
+
+"""
+import base64
+import calendar
+from datetime import datetime
+
+from django.conf import settings
+from django.utils import timezone
+
+
+def encode_cursor(key):
+    """ Encode a sort key as an opaque cursor
+
+    :param key:     The sort key of the last item on a page
+    :type key:      tuple of int
+    :return:        URL-safe cursor string
+    :rtype:         str
+    """
+    raw = ":".join(str(int(x)) for x in key)
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip("=")
+
+
+def decode_cursor(cursor, length):
+    """ Decode a cursor made by encode_cursor
+
+    :param cursor:  The cursor string
+    :type cursor:   str
+    :param length:  Number of values the sort key must have
+    :type length:   int
+    :return:        The sort key
+    :rtype:         tuple of int
+    :raises ValueError: If the cursor is malformed
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('ascii')
+        key = tuple(int(x) for x in raw.split(":"))
+    except (TypeError, UnicodeError, ValueError):
+        raise ValueError("Invalid cursor: %r" % cursor)
+    if len(key) != length:
+        raise ValueError("Invalid cursor: %r" % cursor)
+    return key
+
+
+def datetime_to_micros(value):
+    """ Get a datetime as microseconds since the epoch, for use in sort keys
+
+    Naive datetimes are taken to be in UTC.
+
+    :param value:   The datetime
+    :type value:    datetime.datetime
+    :rtype:         int
+    """
+    return calendar.timegm(value.utctimetuple()) * 10 ** 6 + value.microsecond
+
+
+def micros_to_datetime(micros):
+    """ Get the datetime a value from datetime_to_micros stands for
+
+    The result is aware when time zone support is enabled.
+
+    :param micros:  Microseconds since the epoch
+    :type micros:   int
+    :rtype:         datetime.datetime
+    """
+    value = datetime.utcfromtimestamp(micros // 10 ** 6) \
+        .replace(microsecond=micros % 10 ** 6)
+    if settings.USE_TZ:
+        value = timezone.make_aware(value, timezone.utc)
+    return value
@@ -0,0 +1,110 @@
+"""
+Rate Limiting
+*************
+
+Token buckets for scheduling calls to rate-limited APIs.
+
+"""
+import threading
+import time
+
+
+class TokenBucket(object):
+    """ Calls allowed within a fixed rate-limit window
+
+    Starts full and refills completely when the window resets.  When the API
+    reports its own remaining calls and reset time, those take precedence
+    over local counting.
+    """
+    def __init__(self, capacity, window, clock=time.time):
+        """
+        :param capacity:    Calls allowed per window
+        :type capacity:     int
+        :param window:      Window length in seconds
+        :type window:       float
+        :param clock:       Returns the current time in seconds
+        :type clock:        callable
+        """
+        self.capacity = capacity
+        self.window = window
+        self.clock = clock
+        self.tokens = capacity
+        self.reset_at = clock() + window
+
+    def _refill(self):
+        now = self.clock()
+        if now >= self.reset_at:
+            self.tokens = self.capacity
+            self.reset_at = now + self.window
+
+    def try_acquire(self):
+        """ Take a token if one is available
+
+        :return:    Whether the call may proceed
+        :rtype:     bool
+        """
+        self._refill()
+        if self.tokens > 0:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        """ Get the seconds until a token is available
+
+        :rtype:     float
+        """
+        self._refill()
+        return 0. if self.tokens > 0 else max(0., self.reset_at - self.clock())
+
+    def update(self, remaining=None, reset_at=None):
+        """ Align the bucket with limits reported by the API
+
+        :param remaining:   Calls left in the current window
+        :type remaining:    int
+        :param reset_at:    Epoch seconds when the window resets
+        :type reset_at:     float
+        """
+        if remaining is not None:
+            self.tokens = max(0, int(remaining))
+        if reset_at is not None:
+            self.reset_at = float(reset_at)
+
+
+class RateLimitScheduler(object):
+    """ One token bucket per key, such as per linked account """
+
+    def __init__(self, capacity, window, clock=time.time):
+        self.capacity = capacity
+        self.window = window
+        self.clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, key):
+        """ Get the bucket of a key, creating it full
+
+        :rtype:     TokenBucket
+        """
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.capacity, self.window,
+                                                 clock=self.clock)
+            return self._buckets[key]
+
+    def ready(self, keys):
+        """ Get the keys that can make a call now
+
+        :param keys:    Keys to check
+        :type keys:     iterable
+        :return:        Keys with a token available
+        :rtype:         list
+        """
+        return [key for key in keys if self.bucket(key).wait_time() == 0]
+
+    def next_ready_in(self, keys):
+        """ Get the seconds until any of the keys can make a call
+
+        :rtype:     float
+        """
+        return min([self.bucket(key).wait_time() for key in keys] or [0.])
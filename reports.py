@@ -0,0 +1,97 @@
+"""
+Rent Reports
+************
+
+Portfolio-level delinquency reporting, aggregated in the database.
+
+"""
+from datetime import timedelta
+
+from django.db.models import Case, Count, IntegerField, Min, Sum, When
+from contracts.models import ManagementContract
+from finances.models import Invoice
+
+#: Aging buckets, as (name, most days late, fewest days late).  None is open.
+AGING_BUCKETS = (
+    ('current', 0, None),
+    ('late_1_30', 30, 1),
+    ('late_31_60', 60, 31),
+    ('late_60_plus', None, 61),
+)
+
+
+def _bucket_counts(today):
+    """ Build one conditional count per aging bucket
+
+    :param today:   The date to age invoices against
+    :type today:    datetime.date
+    :return:        Aggregate expressions keyed by bucket name
+    :rtype:         dict
+    """
+    counts = {}
+    for name, most, fewest in AGING_BUCKETS:
+        lookup = {}
+        if most is not None:
+            lookup['due_date__gte'] = today - timedelta(days=most)
+        if fewest is not None:
+            lookup['due_date__lte'] = today - timedelta(days=fewest)
+        counts[name] = Sum(Case(When(then=1, **lookup), default=0,
+                                output_field=IntegerField()))
+    return counts
+
+
+def unpaid_rent_invoices(manager, today):
+    """ Get the unpaid rent invoices on properties a manager controls
+
+    :param manager:     The managing user
+    :type manager:      UserProfile
+    :param today:       Date the management contracts must be active on
+    :type today:        datetime.date
+    :return:            Query set of unpaid rent invoices
+    :rtype:             django.models.QuerySet
+    """
+    managed = ManagementContract.objects.filter(manager=manager,
+                                                start_date__lte=today,
+                                                end_date__gte=today)
+    return Invoice.objects.filter(type__name="Rent", paid_date__isnull=True,
+                                  due_date__isnull=False,
+                                  property__in=managed.values('property'))
+
+
+def rent_aging_totals(manager, today):
+    """ Count unpaid rent invoices per aging bucket
+
+    Buckets are current (not yet due), 1-30, 31-60 and more than 60 days past
+    the due date.
+
+    :param manager:     The managing user
+    :type manager:      UserProfile
+    :param today:       The date to age invoices against
+    :type today:        datetime.date
+    :return:            Invoice counts keyed by bucket name
+    :rtype:             dict
+    """
+    totals = unpaid_rent_invoices(manager, today).aggregate(**_bucket_counts(today))
+    return dict((name, count or 0) for name, count in totals.items())
+
+
+def rent_aging_rows(manager, today):
+    """ Stream per-tenant aging rows
+
+    Each row is a dict with ``payer``, ``property``, ``invoices``,
+    ``oldest_due`` and one count per aging bucket.  Rows are read from a
+    server-side iterator so large portfolios are never held in memory.
+
+    :param manager:     The managing user
+    :type manager:      UserProfile
+    :param today:       The date to age invoices against
+    :type today:        datetime.date
+    :return:            Aging rows ordered by property and tenant
+    :rtype:             generator of dict
+    """
+    rows = unpaid_rent_invoices(manager, today).values('property', 'payer') \
+        .annotate(invoices=Count('pk'), oldest_due=Min('due_date'),
+                  **_bucket_counts(today)) \
+        .order_by('property', 'payer')
+    for row in rows.iterator():
+        yield row
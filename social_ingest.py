@@ -0,0 +1,309 @@
+"""
+Social Ingestion
+****************
+
+A pluggable engine keeping linked social accounts in sync.  Each channel
+provides a Connector; the engine runs fetches on a bounded worker pool fed by
+a bounded queue, limits concurrent fetches per user and hands fetched
+messages to a single writer that stores them in batches.  It is the only
+path storing synced tweets; run it with the sync_twitter command.
+
+"""
+from collections import defaultdict
+import itertools
+import logging
+import threading
+import time
+
+from django.db import connection
+from django.utils.six.moves import queue
+from unified_messages.models import TwitterAuth
+
+from .ingestion import ingest_tweets
+from .twitter_sync import TimelineSyncer
+
+_DONE = object()
+
+
+class Connector(object):
+    """ Interface of a channel the engine can ingest from """
+
+    #: Name of the channel, e.g. "Tweet"
+    channel = None
+
+    def accounts(self):
+        """ Get the linked accounts to sync
+
+        :return:    (account key, user profile) pairs
+        :rtype:     iterable of tuple
+        """
+        raise NotImplementedError
+
+    def fetch(self, account):
+        """ Fetch the new messages of an account
+
+        Called from worker threads, so it must not share unsafe state.
+
+        :param account:     Account key from accounts()
+        :return:            Messages in the form store() accepts
+        :rtype:             list
+        """
+        raise NotImplementedError
+
+    def store(self, user_profile, messages):
+        """ Store a batch of one user's messages
+
+        Called from the writer thread only.
+
+        :param user_profile:    The messages' owner
+        :type user_profile:     UserProfile
+        :param messages:        Messages returned by fetch()
+        :type messages:         list
+        :return:                Number of messages stored
+        :rtype:                 int
+        """
+        raise NotImplementedError
+
+    def checkpoint(self, account):
+        """ Record that everything fetched from an account so far is stored
+
+        Called from the writer thread only, after the store() call that
+        covers the account's last fetch.
+
+        :param account:     Account key from accounts()
+        """
+        pass
+
+    def next_ready_in(self):
+        """ Get the seconds until an account has something to fetch
+
+        :return:    Seconds, or None if the channel has no preference
+        :rtype:     float
+        """
+        return None
+
+
+class TwitterConnector(Connector):
+    """ Home timelines of linked Twitter accounts
+
+    Timeline paging and rate limits are handled by TimelineSyncer.  The
+    advanced checkpoint of a fetch is held until its tweets are stored.
+    """
+    channel = "Tweet"
+
+    def __init__(self, syncer=None):
+        self.syncer = syncer or TimelineSyncer()
+        self._checkpoints = {}
+        self._lock = threading.Lock()
+
+    def accounts(self):
+        return [(auth, auth.user) for auth in
+                TwitterAuth.objects.filter(final=True).select_related('user')
+                if self.syncer.scheduler.bucket(auth.pk).wait_time() == 0]
+
+    def fetch(self, account):
+        tweets, checkpoint = self.syncer.fetch_auth(account)
+        with self._lock:
+            self._checkpoints[account.pk] = checkpoint
+        return tweets
+
+    def store(self, user_profile, messages):
+        return ingest_tweets(user_profile, messages)
+
+    def checkpoint(self, account):
+        with self._lock:
+            checkpoint = self._checkpoints.pop(account.pk, None)
+        if checkpoint is not None:
+            checkpoint.save()
+
+    def next_ready_in(self):
+        keys = TwitterAuth.objects.filter(final=True).values_list('pk', flat=True)
+        return self.syncer.scheduler.next_ready_in(keys)
+
+
+class FakeConnector(Connector):
+    """ Generates synthetic messages for load testing without network access
+
+    Stored messages are counted, not written to the database.
+    """
+    def __init__(self, channel="Fake", accounts=100, messages_per_fetch=20,
+                 latency=0.05):
+        """
+        :param channel:             Name of the fake channel
+        :type channel:              str
+        :param accounts:            Number of fake accounts
+        :type accounts:             int
+        :param messages_per_fetch:  Messages returned by every fetch
+        :type messages_per_fetch:   int
+        :param latency:             Seconds every fetch sleeps, standing in
+                                    for the network round trip
+        :type latency:              float
+        """
+        self.channel = channel
+        self.account_count = accounts
+        self.messages_per_fetch = messages_per_fetch
+        self.latency = latency
+        self.stored = 0
+        self.batches = 0
+        self._ids = itertools.count()
+
+    def accounts(self):
+        return [(account, "fake-user-%d" % account)
+                for account in range(self.account_count)]
+
+    def fetch(self, account):
+        time.sleep(self.latency)
+        return [{'externalId': "%s-%d" % (self.channel, next(self._ids)),
+                 'sender': "account-%d" % account,
+                 'body': "Synthetic message"}
+                for _ in range(self.messages_per_fetch)]
+
+    def store(self, user_profile, messages):
+        self.stored += len(messages)
+        self.batches += 1
+        return len(messages)
+
+
+class IngestionEngine(object):
+    """ Runs connector fetches concurrently and stores results in batches """
+
+    def __init__(self, connectors, workers=16, queue_size=1000, per_user=2,
+                 batch_size=200, flush_interval=1.0):
+        """
+        :param connectors:      Channels to ingest from
+        :type connectors:       list of Connector
+        :param workers:         Fetches running at once
+        :type workers:          int
+        :param queue_size:      Pending fetches and pending writes held at
+                                once; producers block when it is full
+        :type queue_size:       int
+        :param per_user:        Fetches running at once for one user
+        :type per_user:         int
+        :param batch_size:      Messages per store() call
+        :type batch_size:       int
+        :param flush_interval:  Most seconds a partial batch waits
+        :type flush_interval:   float
+        """
+        self.connectors = connectors
+        self.workers = workers
+        self.queue_size = queue_size
+        self.per_user = per_user
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = defaultdict(int)
+        self._user_slots = defaultdict(lambda: threading.BoundedSemaphore(self.per_user))
+        self._slots_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def _slot(self, user_profile):
+        with self._slots_lock:
+            return self._user_slots[user_profile]
+
+    def _work(self, jobs, results):
+        try:
+            while True:
+                job = jobs.get()
+                try:
+                    if job is _DONE:
+                        return
+                    connector, account, user_profile = job
+                    with self._slot(user_profile):
+                        messages = connector.fetch(account)
+                    self._count('fetches')
+                    # Sent even when empty, so the account is checkpointed
+                    results.put((connector, account, user_profile, messages))
+                except Exception:
+                    self._count('errors')
+                    logging.exception("Fetch failed for %s account %s" % (job[0].channel,
+                                                                          job[1]))
+                finally:
+                    jobs.task_done()
+        finally:
+            connection.close()
+
+    def _write(self, results):
+        try:
+            self._write_batches(results)
+        finally:
+            connection.close()
+
+    def _write_batches(self, results):
+        # Messages and fetched accounts waiting to be stored, per connector and user
+        pending = defaultdict(lambda: ([], []))
+        last_flush = time.time()
+        done = False
+        while not done:
+            try:
+                item = results.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+            if item is _DONE:
+                done = True
+            elif item is not None:
+                connector, account, user_profile, messages = item
+                batch, accounts = pending[(connector, user_profile)]
+                batch.extend(messages)
+                accounts.append(account)
+                if len(batch) >= self.batch_size:
+                    self._store(connector, user_profile,
+                                *pending.pop((connector, user_profile)))
+            if done or time.time() - last_flush >= self.flush_interval:
+                for (connector, user_profile), (batch, accounts) in list(pending.items()):
+                    self._store(connector, user_profile, batch, accounts)
+                pending.clear()
+                last_flush = time.time()
+
+    def _store(self, connector, user_profile, messages, accounts):
+        try:
+            if messages:
+                self._count('stored', connector.store(user_profile, messages))
+                self._count('batches')
+            for account in accounts:
+                connector.checkpoint(account)
+        except Exception:
+            self._count('errors')
+            logging.exception("Storing %d %s messages failed" % (len(messages),
+                                                                 connector.channel))
+
+    def run_once(self):
+        """ Sync every account of every connector once
+
+        :return:    Counters of fetches, stored messages, batches and errors
+        :rtype:     dict
+        """
+        jobs = queue.Queue(self.queue_size)
+        results = queue.Queue(self.queue_size)
+        workers = [threading.Thread(target=self._work, args=(jobs, results))
+                   for _ in range(self.workers)]
+        writer = threading.Thread(target=self._write, args=(results,))
+        for thread in workers + [writer]:
+            thread.daemon = True
+            thread.start()
+
+        for connector in self.connectors:
+            for account, user_profile in connector.accounts():
+                jobs.put((connector, account, user_profile))
+        for _ in workers:
+            jobs.put(_DONE)
+        for thread in workers:
+            thread.join()
+        results.put(_DONE)
+        writer.join()
+        return dict(self.stats)
+
+    def run_forever(self, interval=60):
+        """ Sync all accounts as often as the connectors allow
+
+        :param interval:    Most seconds to wait between passes
+        :type interval:     int
+        """
+        while True:
+            stats = self.run_once()
+            logging.info("Ingestion totals: %s" % stats)
+            waits = [connector.next_ready_in() for connector in self.connectors]
+            time.sleep(max(1, min([interval] + [wait for wait in waits
+                                                if wait is not None])))
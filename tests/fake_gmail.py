@@ -0,0 +1,236 @@
+"""
+Fake GMail API
+**************
+
+A local HTTP stand-in for the parts of the GMail v1 API the sync worker
+uses: the discovery document, users.getProfile, users.messages.list,
+users.messages.get and users.history.list.
+
+"""
+import base64
+import json
+import re
+import threading
+
+from django.utils.six.moves import BaseHTTPServer
+from django.utils.six.moves.urllib.parse import parse_qs, urlparse
+
+
+def _method(method_id, path, parameters, response=None):
+    method = {'id': method_id, 'path': path, 'httpMethod': 'GET',
+              'parameters': dict((name, dict({'type': 'string', 'location': 'query'},
+                                             **options))
+                                 for name, options in parameters.items()),
+              'parameterOrder': [name for name, options in parameters.items()
+                                 if options.get('required')]}
+    if response:
+        method['response'] = {'$ref': response}
+    return method
+
+
+def discovery_document(root_url):
+    """ Build a discovery document for the fake API
+
+    :param root_url:    Base URL of the fake server, ending with a slash
+    :type root_url:     str
+    :rtype:             dict
+    """
+    user = {'location': 'path', 'required': True}
+    return {
+        'kind': 'discovery#restDescription', 'discoveryVersion': 'v1',
+        'id': 'gmail:v1', 'name': 'gmail', 'version': 'v1',
+        'rootUrl': root_url, 'servicePath': 'gmail/v1/users/',
+        'baseUrl': root_url + 'gmail/v1/users/', 'batchPath': 'batch',
+        'protocol': 'rest', 'parameters': {},
+        'schemas': {
+            'Profile': {'id': 'Profile', 'type': 'object'},
+            'Message': {'id': 'Message', 'type': 'object'},
+            'ListMessagesResponse': {'id': 'ListMessagesResponse', 'type': 'object',
+                                     'properties': {'nextPageToken': {'type': 'string'}}},
+            'ListHistoryResponse': {'id': 'ListHistoryResponse', 'type': 'object',
+                                    'properties': {'nextPageToken': {'type': 'string'}}},
+        },
+        'resources': {'users': {
+            'methods': {
+                'getProfile': _method('gmail.users.getProfile', '{userId}/profile',
+                                      {'userId': user}, 'Profile'),
+            },
+            'resources': {
+                'messages': {'methods': {
+                    'list': _method('gmail.users.messages.list', '{userId}/messages',
+                                    {'userId': user, 'maxResults': {'type': 'integer'},
+                                     'pageToken': {}},
+                                    'ListMessagesResponse'),
+                    'get': _method('gmail.users.messages.get', '{userId}/messages/{id}',
+                                   {'userId': user,
+                                    'id': {'location': 'path', 'required': True},
+                                    'format': {}},
+                                   'Message'),
+                }},
+                'history': {'methods': {
+                    'list': _method('gmail.users.history.list', '{userId}/history',
+                                    {'userId': user, 'startHistoryId': {},
+                                     'historyTypes': {}, 'pageToken': {}},
+                                    'ListHistoryResponse'),
+                }},
+            },
+        }},
+    }
+
+
+class FakeMailbox(object):
+    """ The state served by the fake API
+
+    Messages are kept newest first, and every added message bumps the
+    history id, like GMail does.
+    """
+    def __init__(self, page_size=2):
+        self.page_size = page_size
+        self.messages = []
+        self.raw = {}
+        self.history = []
+        self.history_id = 1000
+        # History ids before this one answer 404, as expired ones do
+        self.oldest_history_id = 0
+        # Statuses to answer requests with before serving them, by path prefix
+        self.failures = {}
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def add(self, message_id, raw):
+        """ Add a message to the mailbox
+
+        :param message_id:  GMail message id
+        :type message_id:   str
+        :param raw:         The RFC 2822 message
+        :type raw:          bytes
+        """
+        with self._lock:
+            self.history_id += 1
+            self.messages.insert(0, message_id)
+            self.raw[message_id] = raw
+            self.history.append((self.history_id, message_id))
+
+    def delete(self, message_id):
+        """ Delete a message, keeping it in the history """
+        with self._lock:
+            self.messages.remove(message_id)
+            del self.raw[message_id]
+
+    def fail(self, path, *statuses):
+        """ Answer the next requests under a path with error statuses
+
+        :param path:        Path prefix below /gmail/v1/users/me/
+        :type path:         str
+        :param statuses:    HTTP statuses, one per request
+        :type statuses:     int
+        """
+        with self._lock:
+            self.failures.setdefault(path, []).extend(statuses)
+
+    def requested(self, path):
+        """ Count the requests made under a path prefix """
+        with self._lock:
+            return len([request for request in self.requests
+                        if request.startswith(path)])
+
+    def _page(self, items, query):
+        start = int(query.get('pageToken', ['0'])[0])
+        size = min(int(query.get('maxResults', [self.page_size])[0]), self.page_size)
+        page = {}
+        if start + size < len(items):
+            page['nextPageToken'] = str(start + size)
+        return items[start:start+size], page
+
+    def respond(self, path, query):
+        """ Answer an API request
+
+        :return:    HTTP status and JSON body
+        :rtype:     tuple
+        """
+        with self._lock:
+            self.requests.append(path)
+            for prefix, statuses in self.failures.items():
+                if path.startswith(prefix) and statuses:
+                    return statuses.pop(0), {'error': {'code': 0, 'message': 'Fake failure'}}
+
+            if path == 'profile':
+                return 200, {'emailAddress': 'me@example.com',
+                             'historyId': str(self.history_id)}
+            if path == 'messages':
+                ids, page = self._page(self.messages, query)
+                page['messages'] = [{'id': message_id, 'threadId': message_id}
+                                    for message_id in ids]
+                return 200, page
+            match = re.match(r'messages/([^/]+)$', path)
+            if match:
+                raw = self.raw.get(match.group(1))
+                if raw is None:
+                    return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+                return 200, {'id': match.group(1),
+                             'raw': base64.urlsafe_b64encode(raw).decode('ascii')}
+            if path == 'history':
+                start = int(query['startHistoryId'][0])
+                if start < self.oldest_history_id:
+                    return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+                records = [{'id': str(history_id),
+                            'messagesAdded': [{'message': {'id': message_id}}]}
+                           for history_id, message_id in self.history
+                           if history_id > start]
+                records, page = self._page(records, query)
+                page['history'] = records
+                page['historyId'] = str(self.history_id)
+                return 200, page
+            return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+
+
+class FakeGMailServer(object):
+    """ Serves a FakeMailbox over HTTP on a local port, from a thread
+
+    Usage::
+
+        server = FakeGMailServer()
+        server.start()
+        ...
+        server.stop()
+
+    GMAIL_DISCOVERY_URL should be set to ``server.discovery_url``.
+    """
+    def __init__(self, mailbox=None):
+        self.mailbox = mailbox or FakeMailbox()
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.startswith('/discovery/'):
+                    status, body = 200, discovery_document(server.url)
+                elif url.path.startswith('/gmail/v1/users/me/'):
+                    status, body = server.mailbox.respond(
+                        url.path[len('/gmail/v1/users/me/'):], parse_qs(url.query))
+                else:
+                    status, body = 404, {}
+                content = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/' % self.httpd.server_address[1]
+        self.discovery_url = self.url + 'discovery/{api}/{apiVersion}'
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
@@ -0,0 +1,160 @@
+from contextlib import contextmanager
+from email.mime.text import MIMEText
+
+from apiclient.discovery import build_from_document
+from apiclient.errors import HttpError
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+import httplib2
+from unified_messages.models import Message
+from user_profiles.models import UserProfile
+
+from .. import gmail_clients
+from ..gmail_clients import discovery_document
+from ..gmail_sync import GMailSyncWorker, execute
+from ..models import GMailSyncCheckpoint
+from .fake_gmail import FakeGMailServer
+
+
+def make_email(subject, body, to="tenant@example.com"):
+    msg = MIMEText(body)
+    msg['From'] = "manager@example.com"
+    if to:
+        msg['To'] = to
+    if subject:
+        msg['Subject'] = subject
+    msg['Date'] = "Mon, 5 Oct 2015 10:00:00 +0000"
+    return msg.as_string().encode('utf-8')
+
+
+def fake_service(credential):
+    return build_from_document(discovery_document(), http=httplib2.Http())
+
+
+@contextmanager
+def fake_client(credential):
+    yield fake_service(credential)
+
+
+class GMailSyncTest(TestCase):
+
+    def setUp(self):
+        self.server = FakeGMailServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.mailbox = self.server.mailbox
+
+        settings_override = override_settings(GMAIL_DISCOVERY_URL=self.server.discovery_url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        gmail_clients._discovery.clear()
+        self.addCleanup(gmail_clients._discovery.clear)
+
+        self.user = User.objects.create_user('tenant', 'tenant@example.com', 'secret')
+        self.user_profile = UserProfile.objects.create(user=self.user)
+        self.worker = GMailSyncWorker(client_factory=fake_client, initial_messages=3,
+                                      concurrency=2)
+
+    def add_messages(self, *message_ids):
+        for message_id in message_ids:
+            self.mailbox.add(message_id, make_email("Subject %s" % message_id,
+                                                    "Body of %s" % message_id))
+
+    def sync(self):
+        return self.worker.sync_user(self.user.pk, None)
+
+    def stored_ids(self):
+        return set(Message.objects.filter(user_profile=self.user_profile)
+                   .values_list('external_id', flat=True))
+
+    def history_id(self):
+        return GMailSyncCheckpoint.objects.get(user=self.user).history_id
+
+    def test_first_sync_stores_recent_messages(self):
+        self.add_messages('m1', 'm2', 'm3', 'm4', 'm5')
+
+        self.assertEqual(self.sync(), 3)
+
+        self.assertEqual(self.stored_ids(), set(['m3', 'm4', 'm5']))
+        self.assertEqual(self.history_id(), str(self.mailbox.history_id))
+        self.assertEqual(self.mailbox.requested('history'), 0)
+
+    def test_history_sync_fetches_only_new_messages(self):
+        self.add_messages('m1', 'm2')
+        self.sync()
+        self.add_messages('m3', 'm4')
+        listed = self.mailbox.requests.count('messages')
+
+        self.assertEqual(self.sync(), 2)
+
+        self.assertEqual(self.stored_ids(), set(['m1', 'm2', 'm3', 'm4']))
+        self.assertEqual(self.mailbox.requests.count('messages'), listed)
+        self.assertEqual(self.mailbox.requested('messages/m1'), 1)
+        self.assertEqual(self.history_id(), str(self.mailbox.history_id))
+
+    def test_expired_history_falls_back_to_recent_messages(self):
+        self.add_messages('m1')
+        self.sync()
+        self.add_messages('m2', 'm3')
+        self.mailbox.oldest_history_id = self.mailbox.history_id + 1
+
+        self.assertEqual(self.sync(), 2)
+
+        self.assertEqual(self.stored_ids(), set(['m1', 'm2', 'm3']))
+        self.assertEqual(self.history_id(), str(self.mailbox.history_id))
+
+    def test_deleted_and_malformed_messages_are_skipped(self):
+        self.add_messages('m1')
+        self.sync()
+        self.add_messages('m2', 'm3')
+        self.mailbox.add('m4', make_email(None, "No subject", to=None))
+        self.mailbox.delete('m2')
+
+        self.assertEqual(self.sync(), 2)
+
+        self.assertEqual(self.stored_ids(), set(['m1', 'm3', 'm4']))
+        self.assertEqual(self.history_id(), str(self.mailbox.history_id))
+
+    def test_failed_fetches_are_synced_again(self):
+        self.add_messages('m1')
+        self.sync()
+        synced_history_id = self.history_id()
+        self.add_messages('m2', 'm3')
+        self.mailbox.fail('messages/m2', 503)
+        self.worker.retries = 0
+
+        self.assertEqual(self.sync(), 1)
+        self.assertEqual(self.history_id(), synced_history_id)
+
+        self.assertEqual(self.sync(), 1)
+        self.assertEqual(self.stored_ids(), set(['m1', 'm2', 'm3']))
+        self.assertEqual(self.history_id(), str(self.mailbox.history_id))
+
+    def test_retries_rate_limiting_and_server_errors(self):
+        self.add_messages('m1')
+        self.mailbox.fail('messages/m1', 429, 503)
+        request = fake_service(None).users().messages().get(userId='me', id='m1',
+                                                            format='raw')
+
+        self.assertEqual(execute(request, backoff=0)['id'], 'm1')
+        self.assertEqual(self.mailbox.requested('messages/m1'), 3)
+
+    def test_does_not_retry_client_errors(self):
+        self.add_messages('m1')
+        self.mailbox.fail('messages/m1', 400)
+        request = fake_service(None).users().messages().get(userId='me', id='m1',
+                                                            format='raw')
+
+        with self.assertRaises(HttpError):
+            execute(request, backoff=0)
+        self.assertEqual(self.mailbox.requested('messages/m1'), 1)
+
+    def test_gives_up_after_the_last_retry(self):
+        self.add_messages('m1')
+        self.mailbox.fail('messages/m1', 500, 500, 500)
+        request = fake_service(None).users().messages().get(userId='me', id='m1',
+                                                            format='raw')
+
+        with self.assertRaises(HttpError):
+            execute(request, retries=2, backoff=0)
+        self.assertEqual(self.mailbox.requested('messages/m1'), 3)
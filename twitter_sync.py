@@ -0,0 +1,120 @@
+"""
+Twitter Sync
+************
+
+Fetching of Twitter home timelines for background synchronization.  Each
+fetch pages from the newest tweet down to the stored checkpoint, and calls
+are scheduled per account within Twitter's rate-limit window.  The tweets
+are stored, and the checkpoints saved, by the ingestion engine through
+social_ingest.TwitterConnector.
+
+"""
+import time
+
+from dateutil.parser import parse
+from django.conf import settings
+from django.utils import timezone
+from twython import Twython, TwythonRateLimitError
+
+from .models import TwitterSyncCheckpoint
+from .ratelimit import RateLimitScheduler
+
+#: Home timeline calls allowed per user and window, and the window length
+TIMELINE_CALLS = 15
+TIMELINE_WINDOW = 15 * 60
+
+
+def build_client(auth):
+    """ Build a Twython client for a linked account
+
+    :param auth:    The account's final authorization
+    :type auth:     TwitterAuth
+    :rtype:         twython.Twython
+    """
+    return Twython(settings.TWITTER_APP_KEY,
+                   settings.TWITTER_APP_SECRET,
+                   auth.oauth_token,
+                   auth.oauth_token_secret)
+
+
+def _header(twitter, name):
+    try:
+        return twitter.get_lastfunction_header(name)
+    except Exception:
+        return None
+
+
+class TimelineSyncer(object):
+    """ Fetches linked Twitter accounts' home timelines """
+
+    def __init__(self, client_factory=build_client, page_size=200,
+                 scheduler=None):
+        """
+        :param client_factory:  Builds a Twython client from a TwitterAuth
+        :type client_factory:   callable
+        :param page_size:       Tweets requested per call, at most 200
+        :type page_size:        int
+        :param scheduler:       Rate-limit buckets, keyed by TwitterAuth id
+        :type scheduler:        RateLimitScheduler
+        """
+        self.client_factory = client_factory
+        self.page_size = page_size
+        self.scheduler = scheduler or RateLimitScheduler(TIMELINE_CALLS,
+                                                         TIMELINE_WINDOW)
+
+    def fetch_auth(self, auth):
+        """ Page one timeline from its checkpoint while calls are left
+
+        Nothing is written: the checkpoint is advanced but not saved, and
+        should only be saved once the returned tweets are stored.
+
+        :param auth:    The account's final authorization
+        :type auth:     TwitterAuth
+        :return:        ingest_tweets arguments of the fetched tweets, and the
+                        advanced checkpoint
+        :rtype:         tuple
+        """
+        try:
+            checkpoint = TwitterSyncCheckpoint.objects.get(auth=auth)
+        except TwitterSyncCheckpoint.DoesNotExist:
+            checkpoint = TwitterSyncCheckpoint(auth=auth)
+        bucket = self.scheduler.bucket(auth.pk)
+        twitter = self.client_factory(auth)
+        fetched = []
+
+        while bucket.try_acquire():
+            kwargs = {'count': self.page_size}
+            if checkpoint.since_id is not None:
+                kwargs['since_id'] = checkpoint.since_id
+            if checkpoint.max_id is not None:
+                kwargs['max_id'] = checkpoint.max_id
+            try:
+                tweets = twitter.get_home_timeline(**kwargs)
+            except TwythonRateLimitError as e:
+                bucket.update(remaining=0,
+                              reset_at=time.time() + int(e.retry_after or TIMELINE_WINDOW))
+                break
+            finally:
+                bucket.update(remaining=_header(twitter, 'x-rate-limit-remaining'),
+                              reset_at=_header(twitter, 'x-rate-limit-reset'))
+
+            fetched.extend({'created_date': parse(tweet['created_at']),
+                            'sender': tweet['user']['name'],
+                            'body': tweet['text'],
+                            'externalId': tweet['id']}
+                           for tweet in tweets)
+
+            if not tweets:
+                # Reached the checkpoint, the gap is closed
+                if checkpoint.newest_id is not None:
+                    checkpoint.since_id = checkpoint.newest_id
+                checkpoint.max_id = None
+                checkpoint.newest_id = None
+                break
+
+            ids = [tweet['id'] for tweet in tweets]
+            checkpoint.newest_id = max([checkpoint.newest_id or 0] + ids)
+            checkpoint.max_id = min(ids) - 1
+
+        checkpoint.last_synced = timezone.now()
+        return fetched, checkpoint
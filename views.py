@@ -1,33 +1,71 @@
-import base64
-import email
 import datetime
-import logging
 import os
-import quopri
-from dateutil.parser import parse
+import threading
 from django.db.models import Q
-from django.shortcuts import redirect
-from django.views.generic import RedirectView, ListView
-import httplib2
-from oauth2client import xsrfutil
-from oauth2client.client import flow_from_clientsecrets, Storage
-import twython
+from django.http import FileResponse, Http404, HttpResponseNotModified, JsonResponse
+from django.shortcuts import get_object_or_404, redirect
+from django.views.generic import RedirectView, ListView, View
 from neighborhood_space import settings
 from ns_helpers.helpers import LoginRequiredMixin
 from unified_messages.models import Message, GMailCredential, TwitterAuth
 from unit_manager.helpers import angular_sref
 from user_profiles.models import EmailAccount
-from apiclient.discovery import build
+
+from .models import PropertyImage
+from .pagination import (datetime_to_micros, decode_cursor, encode_cursor,
+                         micros_to_datetime)
 
 
 CLIENT_SECRETS = os.path.join(os.path.dirname(__file__), '..',
                               'client_secret.json')
 
 
-FLOW = flow_from_clientsecrets(
-    CLIENT_SECRETS,
-    scope='https://www.googleapis.com/auth/gmail.readonly',
-    redirect_uri='http://localhost:8000/oauth2callback')
+# The messaging integrations are slow to import and set up, so they are only
+# loaded by the views that use them.
+_flow = []
+_flow_lock = threading.Lock()
+
+
+def get_flow():
+    """ Get the GMail OAuth flow, creating it on first use
+
+    :return:    The OAuth flow
+    :rtype:     oauth2client.client.OAuth2WebServerFlow
+    :raises oauth2client.clientsecrets.InvalidClientSecretsError: If
+                CLIENT_SECRETS is missing or invalid
+    """
+    with _flow_lock:
+        if not _flow:
+            from oauth2client.client import flow_from_clientsecrets
+            _flow.append(flow_from_clientsecrets(
+                CLIENT_SECRETS,
+                scope='https://www.googleapis.com/auth/gmail.readonly',
+                redirect_uri='http://localhost:8000/oauth2callback'))
+        return _flow[0]
+
+
+def gmail_storage(user):
+    """ Get the storage of a user's GMail credential
+
+    :param user:    The credential's owner
+    :type user:     auth.models.User
+    :return:        The credential storage
+    :rtype:         oauth2client.client.Storage
+    """
+    from oauth2client.client import Storage
+    return Storage(GMailCredential, 'id', user, 'credential')
+
+
+def twitter_client(*args):
+    """ Create a Twython client
+
+    :param args:    App key and secret, optionally followed by the user's
+                    OAuth token and secret
+    :return:        The client
+    :rtype:         twython.Twython
+    """
+    from twython import Twython
+    return Twython(*args)
 
 
 class GMailOAuthReturnView(LoginRequiredMixin, RedirectView):
@@ -38,92 +76,89 @@ class GMailOAuthReturnView(LoginRequiredMixin, RedirectView):
         #if not xsrfutil.validate_token(settings.SECRET_KEY, self.request.REQUEST['state'], self.request.user):
         #    raise http.Http404()
 
-        credential = FLOW.step2_exchange(self.request.REQUEST)
-        storage = Storage(GMailCredential, 'id', self.request.user, 'credential')
+        credential = get_flow().step2_exchange(self.request.REQUEST)
+        storage = gmail_storage(self.request.user)
         storage.put(credential)
 
         return super(GMailOAuthReturnView, self).get_redirect_url(*args,
                                                                   **kwargs)
 
 
-class MessageEmailView(LoginRequiredMixin, ListView):
-    """ Email Center View """
-    def get_message(self, service, user_id, msg_id):
-        """ Get a gmail message
+class MessageKeysetMixin(object):
+    """ Newest-first keyset pagination of a user's messages
+
+    Pages are selected with a ``before`` cursor instead of an offset, so every
+    page costs the same however large the mailbox is.  Bodies are deferred
+    and message types joined in; MessageBodyView returns a single body.
+    """
+    page_size = 50
+    # The page is a list, from which ListView cannot name the context variable
+    context_object_name = 'message_list'
+
+    def get_messages(self):
+        """ Get the messages to paginate, before ordering and slicing
 
-        :param service:
-        :param user_id:
-        :param msg_id:
-        :return:
+        :rtype:     django.models.QuerySet
         """
-        message = service.users().messages().get(userId=user_id, id=msg_id,
-                                                 format='raw').execute()
-        return email.message_from_string(base64.urlsafe_b64decode(message['raw'].encode('ASCII')))
+        raise NotImplementedError
+
+    def get_queryset(self):
+        qs = self.get_messages().defer('body').select_related('type') \
+            .order_by('-creation_date', '-pk')
+
+        cursor = self.request.GET.get('before')
+        if cursor:
+            try:
+                micros, pk = decode_cursor(cursor, 2)
+            except ValueError:
+                raise Http404("Invalid page")
+            created = micros_to_datetime(micros)
+            qs = qs.filter(Q(creation_date__lt=created) |
+                           Q(creation_date=created, pk__lt=pk))
+
+        page = list(qs[:self.page_size + 1])
+        self.next_cursor = None
+        if len(page) > self.page_size:
+            page = page[:self.page_size]
+            last = page[-1]
+            self.next_cursor = encode_cursor((datetime_to_micros(last.creation_date),
+                                              last.pk))
+        return page
+
+    def get_context_data(self, **kwargs):
+        context = super(MessageKeysetMixin, self).get_context_data(**kwargs)
+
+        context['next_cursor'] = self.next_cursor
+
+        return context
+
+
+class MessageBodyView(LoginRequiredMixin, View):
+    """ Body of one of the user's messages, for the message centers """
 
+    def get(self, request, pk):
+        message = get_object_or_404(Message, pk=pk,
+                                    user_profile=request.user.userprofile)
+        return JsonResponse({'id': message.pk, 'body': message.body})
+
+
+class MessageEmailView(LoginRequiredMixin, MessageKeysetMixin, ListView):
+    """ Email Center View
+
+    Messages are fetched from GMail by the sync_gmail worker, this view only
+    reads them from the database.
+    """
     def dispatch(self, *args, **kwargs):
         try:
-            gmail_address = self.request.user.userprofile.emailaccount_set.get(type__name="GMail")
-            storage = Storage(GMailCredential, 'id', self.request.user, 'credential')
-            credential = storage.get()
+            self.request.user.userprofile.emailaccount_set.get(type__name="GMail")
+            credential = gmail_storage(self.request.user).get()
             if credential is None or credential.invalid is True:
-                FLOW.params['state'] = xsrfutil.generate_token(settings.SECRET_KEY,
+                from oauth2client import xsrfutil
+                flow = get_flow()
+                flow.params['state'] = xsrfutil.generate_token(settings.SECRET_KEY,
                                                                self.request.user)
-                authorize_url = FLOW.step1_get_authorize_url()
+                authorize_url = flow.step1_get_authorize_url()
                 return redirect(authorize_url)
-            else:
-                # Temporary:  Until the background service that's part of Issue #48
-                # gets made, do on-demand pulls from here
-                http = httplib2.Http()
-                http = credential.authorize(http)
-                service = build("gmail", "v1", http=http)
-
-                response = service.users().messages().list(userId=gmail_address.address,
-                                                           maxResults=10).execute()
-
-                messages = []
-                if 'messages' in response:
-                    messages.extend(response['messages'])
-
-                for message in messages:
-                    if message['id']:
-                        # Skip it if it's already present
-                        messages = Message.objects.filter(user_profile=self.request.user.userprofile,
-                                                          external_id=message['id'])
-                        if len(messages) > 0:
-                            continue
-                    msg = self.get_message(user_id='me', msg_id=message['id'],
-                                           service=service)
-
-                    recipients = msg['to']
-                    if not msg['cc'] is None:
-                        recipients += " " + msg['cc']
-                    sender = msg['from']
-                    subject = quopri.decodestring(msg['subject'])
-                    try:
-                        date = parse(msg['Date'])
-                    except Exception:
-                        date = datetime.now()
-
-                    body = ""
-                    if msg.is_multipart():
-                        for part in msg.walk():
-                            if part.get_content_type() == "text/plain":
-                                body += part.get_payload(decode=True)
-                    else:
-                        body = msg.get_payload()
-
-                    if not date or not sender or not recipients or not subject:
-                        logging.debug("Invalid email.  User: %s, ID: %s" % (self.request.user,
-                                                                            message['id']))
-                    Message.objects.create_email(
-                        user_profile=self.request.user.userprofile,
-                        externalId=message['id'],
-                        created_date=date,
-                        sender=sender,
-                        recipients=recipients,
-                        subject=subject,
-                        body=body
-                    )
         except EmailAccount.DoesNotExist:
             pass
 
@@ -139,65 +174,25 @@ class MessageEmailView(LoginRequiredMixin, ListView):
 
         return context
 
-    def get_queryset(self):
-
-        qs = super(MessageEmailView, self).get_queryset()
-
-        qs = qs.filter(user_profile=self.request.user.userprofile,
-                       type__name="Email")
+    def get_messages(self):
+        return Message.objects.filter(user_profile=self.request.user.userprofile,
+                                      type__name="Email")
 
-        return qs
 
-
-from twython import Twython
-
-
-class MessageSocialView(LoginRequiredMixin, ListView):
+class MessageSocialView(LoginRequiredMixin, MessageKeysetMixin, ListView):
     model = Message
     template_name = "messages/social_center.html"
 
     def dispatch(self, *args, **kwargs):
         return super(MessageSocialView, self).dispatch(*args, **kwargs)
 
-    def get_queryset(self):
-
-        # Temporary until a background service is created to regularly pull
-        # tweets.  Part of Issue #51
-        try:
-            auth = TwitterAuth.objects.get(user=self.request.user.userprofile,
-                                           final=True)
-            twitter = Twython(settings.TWITTER_APP_KEY,
-                              settings.TWITTER_APP_SECRET,
-                              auth.oauth_token,
-                              auth.oauth_token_secret)
-
-            for tweet in twitter.get_home_timeline():
-                # Skip it if it's already present
-                messages = Message.objects.filter(user_profile=self.request.user.userprofile,
-                                                  external_id=tweet['id'])
-                if len(messages) > 0:
-                    continue
-
-                Message.objects.create_tweet(
-                    user_profile=self.request.user.userprofile,
-                    created_date=parse(tweet['created_at']),
-                    sender=tweet['user']['name'],
-                    body=tweet['text'],
-                    externalId=tweet['id']
-                )
-        except twython.TwythonRateLimitError:
-            pass
-        except TwitterAuth.DoesNotExist:
-            pass
-
-        qs = super(MessageSocialView, self).get_queryset()
-
-        return qs.filter(Q(type__name="Facebook") |
-                         Q(type__name="Tweet") |
-                         Q(type__name="Instagram") |
-                         Q(type__name="Pinterest"),
-                         user_profile=self.request.user.userprofile
-        )
+    def get_messages(self):
+        # Tweets are fetched by the sync_twitter worker
+        return Message.objects.filter(Q(type__name="Facebook") |
+                                      Q(type__name="Tweet") |
+                                      Q(type__name="Instagram") |
+                                      Q(type__name="Pinterest"),
+                                      user_profile=self.request.user.userprofile)
 
     def get_context_data(self, **kwargs):
         context = super(MessageSocialView, self).get_context_data(**kwargs)
@@ -218,7 +213,7 @@ class MessageSocialView(LoginRequiredMixin, ListView):
             consumer_key = settings.TWITTER_APP_KEY
             consumer_secret = settings.TWITTER_APP_SECRET
 
-            twitter = Twython(consumer_key, consumer_secret)
+            twitter = twitter_client(consumer_key, consumer_secret)
             auth = twitter.get_authentication_tokens(callback_url="http://dev.neighborhood.space:8000/twitter_callback")
 
             oauth_token = auth['oauth_token']
@@ -241,10 +236,10 @@ class TwitterOAuthCallbackView(LoginRequiredMixin, RedirectView):
             twitter_auth = TwitterAuth.objects.get(user=self.request.user.userprofile,
                                                    final=False)
 
-            twitter = Twython(settings.TWITTER_APP_KEY,
-                              settings.TWITTER_APP_SECRET,
-                              twitter_auth.oauth_token,
-                              twitter_auth.oauth_token_secret)
+            twitter = twitter_client(settings.TWITTER_APP_KEY,
+                                     settings.TWITTER_APP_SECRET,
+                                     twitter_auth.oauth_token,
+                                     twitter_auth.oauth_token_secret)
 
             oauth_verifier = self.request.GET['oauth_verifier']
             final_step = twitter.get_authorized_tokens(oauth_verifier)
@@ -260,3 +255,28 @@ class TwitterOAuthCallbackView(LoginRequiredMixin, RedirectView):
         return angular_sref("message-social")
 
 
+
+
+class PropertyImageVariantView(View):
+    """ Serve a cached thumbnail or web-optimized variant of a property image """
+
+    def get(self, request, pk, variant):
+        from .image_variants import image_cache
+
+        image = get_object_or_404(PropertyImage, pk=pk)
+        try:
+            digest, variant_file = image_cache.open_variant(image.link, variant)
+        except KeyError:
+            raise Http404("Unknown image variant %s" % variant)
+        except ValueError:
+            raise Http404("Image %s has no fetchable link" % pk)
+
+        etag = '"%s-%s"' % (digest, variant)
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            variant_file.close()
+            response = HttpResponseNotModified()
+        else:
+            response = FileResponse(variant_file, content_type='image/jpeg')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'public, max-age=86400'
+        return response